@@ -0,0 +1,33 @@
+import logging
+import optparse
+from ml.inference import apply_to_root
+
+#################################################
+# Arugment parsing
+parser = optparse.OptionParser(usage="usage: %prog [opts]", version="%prog 1.0")
+parser.add_option('-m', '--model',   action='store', type=str, dest='model',   default='', help='Saved model, e.g. models/Test_carl_1000')
+parser.add_option('-i', '--input',  action='store', type=str, dest='input',  default='', help='Input root file')
+parser.add_option('-o', '--output',  action='store', type=str, dest='output',  default='', help='Output root file with the weights, to be used as friend tree of the input')
+parser.add_option('-t', '--TreeName',  action='store', type=str, dest='treename',  default='Tree', help='Name of TTree name inside root files')
+parser.add_option('-f', '--features',  action='store', type=str, dest='features',  default='', help='Comma separated list of features within tree, only needed for models saved without observable names')
+parser.add_option('--step_size',  action='store', type=int, dest='step_size',  default=100000, help='Number of entries read at once')
+parser.add_option('--backend',  action='store', type=str, dest='backend',  default='torch', help='Inference backend, torch or onnxruntime')
+parser.add_option('--s_hat',  action='store_true', dest='s_hat',  default=False, help='Also write the classifier output s_hat')
+(opts, args) = parser.parse_args()
+#################################################
+
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    n_events = apply_to_root(
+        model=opts.model,
+        input_file=opts.input,
+        output_file=opts.output,
+        tree_name=opts.treename,
+        features=[feature for feature in opts.features.split(",") if feature],
+        step_size=opts.step_size,
+        chunk_size=opts.step_size,
+        backend=opts.backend,
+        write_s_hat=opts.s_hat,
+    )
+    logger.info(" Wrote w_carl for %s events to %s", n_events, opts.output)
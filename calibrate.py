@@ -3,6 +3,7 @@ import os
 import sys
 import logging
 from ml import RatioEstimator
+from ml.utils.cache import EvaluationCache
 from ml.utils.loading import Loader
 from ml.calibration import CalibratedClassifier
 from ml.base import Estimator
@@ -29,14 +30,16 @@ else:
 
 carl = RatioEstimator()
 carl.load('models/'+sample+'/'+var+'_carl_'+str(n))
+carl.evaluation_cache = EvaluationCache()
 #load
 evaluate = ['train']
 X = 'data/'+sample+'/'+var+'/X_train_'+str(n)+'.npy'
 y = 'data/'+sample+'/'+var+'/y_train_'+str(n)+'.npy'
 r_hat, s_hat = carl.evaluate(X)
 calib = CalibratedClassifier(carl)
-calib.fit(X=X,y=y)
-p0, p1, r_cal = calib.predict(X=X)
+p0, p1, r_cal = calib.fit_predict(y=y, T=s_hat)
+# Store the calibration in the model bundle, restore with CalibratedClassifier.from_model(carl)
+carl.save('models/'+sample+'/'+var+'_carl_'+str(n), calibrator=calib)
 w_cal = 1/r_cal
 loading.load_calibration(y_true = y,
                          p1_raw = s_hat, 
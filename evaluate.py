@@ -3,6 +3,7 @@ import sys
 import logging
 import optparse
 from ml import RatioEstimator
+from ml.utils.cache import EvaluationCache
 from ml.utils.loading import Loader
 
 #################################################
@@ -39,6 +40,7 @@ else:
 loading = Loader()
 carl = RatioEstimator()
 carl.load('models/'+global_name+'_carl_'+str(n))
+carl.evaluation_cache = EvaluationCache()
 evaluate = ['train','val']
 for i in evaluate:
     print("<evaluate.py::__init__>::   Running evaluation for {}".format(i))
@@ -0,0 +1,35 @@
+import os
+import logging
+import optparse
+from ml.inference import batch_evaluate
+from ml.utils.cache import EvaluationCache
+
+#################################################
+# Arugment parsing
+parser = optparse.OptionParser(usage="usage: %prog [opts]", version="%prog 1.0")
+parser.add_option('-m', '--models',   action='store', type=str, dest='models',   default='', help='Comma separated list of name=path of saved models, one weight column per model')
+parser.add_option('-s', '--samples',  action='store', type=str, dest='samples',  default='', help='Comma separated list of name=path of .npy files with observables')
+parser.add_option('-o', '--output',  action='store', type=str, dest='output',  default='weights/', help='Folder for the combined weights')
+parser.add_option('--chunk_size',  action='store', type=int, dest='chunk_size',  default=100000, help='Events read and evaluated at once')
+parser.add_option('--backend',  action='store', type=str, dest='backend',  default='torch', help='Inference backend, torch or onnxruntime')
+parser.add_option('--s_hat',  action='store_true', dest='s_hat',  default=False, help='Also write the classifier outputs s_hat')
+(opts, args) = parser.parse_args()
+#################################################
+
+logger = logging.getLogger(__name__)
+
+def parse_list(option):
+    # name=path, or only the path with the file name as name
+    return dict(item.split("=", 1) if "=" in item else (os.path.splitext(os.path.basename(item))[0], item) for item in option.split(","))
+
+if __name__ == "__main__":
+    description = batch_evaluate(
+        models=parse_list(opts.models),
+        samples=parse_list(opts.samples),
+        output_dir=opts.output,
+        chunk_size=opts.chunk_size,
+        backend=opts.backend,
+        write_s_hat=opts.s_hat,
+        cache=EvaluationCache(),
+    )
+    logger.info(" Wrote weights of %s models for samples %s to %s", len(description["columns"]), list(description["samples"]), opts.output)
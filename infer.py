@@ -0,0 +1,32 @@
+import logging
+import optparse
+from ml.inference import parallel_evaluate
+from ml.utils.cache import EvaluationCache
+
+#################################################
+# Arugment parsing
+parser = optparse.OptionParser(usage="usage: %prog [opts]", version="%prog 1.0")
+parser.add_option('-m', '--model',   action='store', type=str, dest='model',   default='', help='Saved model, e.g. models/Test_carl_1000')
+parser.add_option('-i', '--inputs',  action='store', type=str, dest='inputs',  default='', help='Comma separated list of .npy files with the observables to evaluate')
+parser.add_option('-o', '--output',  action='store', type=str, dest='output',  default='weights/', help='Folder for the sharded weights and the manifest')
+parser.add_option('-j', '--processes',  action='store', type=int, dest='processes',  default=None, help='Number of worker processes, default: available CPUs / threads')
+parser.add_option('--threads',  action='store', type=int, dest='threads',  default=1, help='Intra-op threads per worker process')
+parser.add_option('--chunk_size',  action='store', type=int, dest='chunk_size',  default=100000, help='Events evaluated at once')
+parser.add_option('--shard_size',  action='store', type=int, dest='shard_size',  default=None, help='Maximal number of events per shard, default: all events divided by the number of processes')
+(opts, args) = parser.parse_args()
+#################################################
+
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    manifest = parallel_evaluate(
+        model_filename=opts.model,
+        inputs=opts.inputs.split(","),
+        output_dir=opts.output,
+        n_processes=opts.processes,
+        threads_per_process=opts.threads,
+        chunk_size=opts.chunk_size,
+        shard_size=opts.shard_size,
+        cache=EvaluationCache(),
+    )
+    logger.info(" Wrote %s shards to %s", len(manifest["shards"]), opts.output)
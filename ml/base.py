@@ -1,16 +1,23 @@
 from __future__ import absolute_import, division, print_function
 
+import io
+import copy
+import hashlib
 import logging
 import os
 import json
+import tempfile
+from collections import OrderedDict
 import numpy as np
 import torch
 import tarfile
 import onnxruntime as ort
 import onnx as onnx
+from torch import nn
 
 
-from .utils.tools import create_missing_folders, load_and_check
+from .utils.tools import create_missing_folders, load_and_check, available_cpus
+from .utils.bundle import write_bundle, load_bundle
 try:
     FileNotFoundError
 except NameError:
@@ -28,17 +35,29 @@ class Estimator(object):
     Please see the tutorial for a detailed walk-through.
     """
 
-    def __init__(self, features=None, n_hidden=(100,), activation="tanh", dropout_prob=0.0):
+    def __init__(self, features=None, n_hidden=(100,), activation="tanh", dropout_prob=0.0, n_ensemble=1):
         self.features = features
         self.n_hidden = n_hidden
         self.activation = activation
         self.dropout_prob = dropout_prob
+        self.n_ensemble = n_ensemble
 
         self.model = None
         self.n_observables = None
         self.n_parameters = None
+        self.observables = None
+        self.scaling = "minmax"
         self.x_scaling_means = None
         self.x_scaling_stds = None
+        self.x_scaling_mins = None
+        self.x_scaling_maxs = None
+        self.quantized = False
+        self.calibration = None
+        self.evaluation_cache = None
+        self._float_model = None
+        self._ort_session = None
+        self._ort_session_threads = None
+        self._model_checksum = None
 
     def train(self, *args, **kwargs):
         raise NotImplementedError
@@ -54,21 +73,36 @@ class Estimator(object):
     def evaluate(self, *args, **kwargs):
         raise NotImplementedError
 
-    def save(self, filename, x, metaData, save_model=False, export_model=False):
+    def save(
+        self, filename, x=None, metaData=None, save_model=False, export_model=False, calibrator=None, legacy_files=True
+    ):
 
         """
-        Saves the trained model to four files: a JSON file with the settings, a pickled pyTorch state dict
-        file, and numpy files for the mean and variance of the inputs (used for input scaling).
-        Also exports model to onnx if export_model is set to True. 
+        Saves the trained model to a single bundle file '<filename>.carl' with the settings, the weights, the input
+        scaling, optionally the calibration and checksums of all arrays, which `Estimator.load()` memory maps.
+        Also exports model to onnx if export_model is set to True. The input scaling is part of the network,
+        so the onnx model takes the unscaled observables as input.
         Parameters
         ----------
         filename : str
-            Path to the files. '_settings.json' and '_state_dict.pl' will be added.
+            Path to the files. '.carl' will be added.
+        x : str or ndarray
+            Not used anymore, the onnx graph is exported with a dynamic batch dimension.
+        metaData : dict
+            Metadata embedded in the onnx model, one entry per observable. Its keys are stored as the names of the
+            observables, which `apply_to_root()` uses to flatten ROOT input the same way as in the training.
         save_model : bool, optional
             If True, the whole model is saved in addition to the state dict. This is not necessary for loading it
             again with Estimator.load(), but can be useful for debugging, for instance to plot the computational graph.
         export_model : bool, optional
             If True, the whole model is exported to .onnx format to be loaded within a C++ envirnoment. 
+        calibrator : CalibratedClassifier or None, optional
+            Fitted calibration stored in the bundle, see `CalibratedClassifier.from_model()`. If None, the calibration
+            of a loaded bundle is kept. Default value: None.
+        legacy_files : bool, optional
+            If True, the settings, the state dict and the scaling are also saved to the separate files
+            '_settings.json', '_state_dict.pt' and '_x_*.npy' of older versions, which existing scripts read.
+            Default value: True.
         Returns
         -------
             None
@@ -82,116 +116,59 @@ class Estimator(object):
         # Check paths
         create_missing_folders([os.path.dirname(filename)])
 
-        # Save settings
-        logger.debug("Saving settings to %s_settings.json", filename)
-
+        # Quantized models are quantized again from the float weights when loading
+        if metaData is not None:
+            self.observables = [str(name) for name in metaData.keys()]
         settings = self._wrap_settings()
-        with open(filename + "_settings.json", "w") as f:
-            json.dump(settings, f)
-        # Save scaling
-        if self.x_scaling_stds is not None and self.x_scaling_means is not None:
-            logger.debug("Saving input scaling information to %s_x_means.npy and %s_x_stds.npy", filename, filename)
-            np.save(filename + "_x_means.npy", self.x_scaling_means)
-            np.save(filename + "_x_stds.npy", self.x_scaling_stds)
-            np.save(filename + "_x_mins.npy", self.x_scaling_mins)
-            np.save(filename + "_x_maxs.npy", self.x_scaling_maxs)
-
-        # Save state dict
-        logger.debug("Saving state dictionary to %s_state_dict.pt", filename)
-        torch.save(self.model.state_dict(), filename + "_state_dict.pt")
-        
+        state_dict = self._unquantized_model().state_dict()
+        scaling = OrderedDict(
+            (name, getattr(self, "x_scaling_" + name))
+            for name in ["means", "stds", "mins", "maxs"]
+            if getattr(self, "x_scaling_" + name) is not None
+        )
+        if calibrator is not None:
+            self.calibration = calibrator._wrap_state()
+
+        # Save bundle
+        logger.debug("Saving bundle to %s.carl", filename)
+        arrays = OrderedDict()
+        for key, value in state_dict.items():
+            arrays["state_dict/" + key] = value.detach().cpu().numpy()
+        for name, value in scaling.items():
+            arrays["scaling/" + name] = np.asarray(value)
+        metadata = {"settings": settings, "calibration": None}
+        if self.calibration is not None:
+            calibration_metadata, calibration_arrays = self.calibration
+            metadata["calibration"] = calibration_metadata
+            for name, value in calibration_arrays.items():
+                arrays["calibration/" + name] = np.asarray(value)
+        write_bundle(filename + ".carl", metadata, arrays)
+
+        if legacy_files:
+            logger.debug("Saving settings, state dict and scaling to separate files")
+            with open(filename + "_settings.json", "w") as f:
+                json.dump(settings, f)
+            for name, value in scaling.items():
+                np.save(filename + "_x_" + name + ".npy", value)
+            torch.save(state_dict, filename + "_state_dict.pt")
+
         # Save model
         if save_model:
             logger.debug("Saving model to %s_model.pt", filename)
             torch.save(self.model, filename + "_model.pt")
 
-        # Export model to onnx
+        # Export model to onnx with a dynamic batch dimension and the metadata embedded
         if export_model:
-            x = load_and_check(x)
-            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-            dummy_input = torch.from_numpy(x[0].reshape(1, -1)).float().to(device)
-            torch.onnx.export(self.model, dummy_input,filename+".onnx", export_params=True, input_names = ['input'],output_names = ['r_hat', 's_hat'], verbose = True)
-
-        # Manipulate onnx model using 'onnxruntime' module directly
-        #  Note: This is inefficient due to I/O reasons, however
-        #        torch.onnx interface seemingly has no options for this
-        if export_model and os.path.isfile(filename+".onnx"):
-            
-            ####################################
-            ##        ONNXRUNTIME
-            ## Example using Onnxruntime instead of Onxx
-            ## Keeping only for prosperity for now
-            ####################################
-            ## Start the normal onnxruntime session using the model
-            ## just saved
-            #ort_session = ort.InferenceSession(filename+".onnx")
-            ## Model Meta data
-            #metaData = ort_session.get_modelmeta()
-            ## Get the custom map
-            #CustomMap = metaData.custom_metadata_map
-            #print("Custom Meta-Data Map: {}".format(CustomMap))
-
-            ## Define a new custom meta data map
-            #CustomMap_new = {"Var1" : 200.0, 
-            #                 "Var2" : 5.0,
-            #                 "Var3" : 1000.0,
-            #                 "Var4" : 400.0,
-            #                 "Var5" : 6.0,
-            #             }
-            #
-            ## Load new custom map into mode
-            #metaData.custom_metadata_map = CustomMap_new
-
-            # Unable to save Onnx model from Onnxruntime Inference session it seems
-            #   -> Makes sense given InferenceSession is designed to access and infer, not 
-            #      a data/model editor session.
-            #ort_session.SaveModelMetadata() # Believe that this does not work
-            ####################################
-            ####################################
-            
-            ####################################
-            ##        ONNX
-            ####################################
-            # Define a new custom meta data map
-            #CustomMap_new = {"Var1" : 200.0, 
-            #                 "Var2" : 5.0,
-            #                 "Var3" : 1000.0,
-            #                 "Var4" : 400.0,
-            #                 "Var5" : 6.0,
-            #             }
-            # Load model
-            model = onnx.load(filename+".onnx")
-            # Get Meta Data
-            for index,(cust_key,cust_var) in enumerate(metaData.items()): 
-                meta = model.metadata_props.add()
-                meta.key = cust_key
-                meta.value = str(cust_var)
-                # Check value
-                logger.info(" New Meta data: %s ",model.metadata_props[index])
-
-                
-            # Save model
-            onnx.save(model, filename+"_new"+".onnx")
-            
-            # Start the normal onnxruntime session using the model
-            # just saved to check that the model was saved with the correct 
-            # metadata
-            ort_session = ort.InferenceSession(filename+"_new"+".onnx")
-            # Model Meta data
-            metaData = ort_session.get_modelmeta()
-            # Print Metadata
-            CustomMap = metaData.custom_metadata_map
-            logger.info(" Custom Meta-Data Map: %s",CustomMap)
-            # Need to close the ort session for comleteness (C-style)
-            ####################################
-            ###################################
-            
+            self.export_onnx(filename + ".onnx", metaData)
+            if self.quantized:
+                self.export_onnx(filename + "_int8.onnx", metaData, quantized=True)
 
         # Tar model if training is done on GPU
         if torch.cuda.is_available():
             tar = tarfile.open("models_out.tar.gz", "w:gz")
-            for name in [filename+".onnx", filename + "_x_stds.npy", filename + "_x_means.npy",  filename + "_x_mins.npy",  filename + "_x_maxs.npy", filename + "_settings.json",  filename + "_state_dict.pt"]:
-                tar.add(name)
+            for name in [filename+".carl", filename+".onnx", filename+"_int8.onnx", filename + "_x_stds.npy", filename + "_x_means.npy",  filename + "_x_mins.npy",  filename + "_x_maxs.npy", filename + "_settings.json",  filename + "_state_dict.pt"]:
+                if os.path.isfile(name):
+                    tar.add(name)
             tar.close()
 
     def makeConfusion(self, filename, x,y):
@@ -203,11 +180,13 @@ class Estimator(object):
     def load(self, filename):
 
         """
-        Loads a trained model from files.
+        Loads a trained model from the bundle '<filename>.carl' or, for models saved by older versions, from the
+        separate files. Bundles are memory mapped and cached per process, so loading the same unchanged bundle
+        again only reads its header; the model itself is built anew every time.
         Parameters
         ----------
         filename : str
-            Path to the files. '_settings.json' and '_state_dict.pl' will be added.
+            Path to the files. '.carl' or '_settings.json' and '_state_dict.pt' will be added.
         Returns
         -------
             None
@@ -215,23 +194,53 @@ class Estimator(object):
 
         logger.info("Loading model from %s", filename)
 
-        # Load settings and create model
-        logger.debug("Loading settings from %s_settings.json", filename)
-        with open(filename + "_settings.json", "r") as f:
-            settings = json.load(f)
+        if os.path.isfile(filename + ".carl"):
+            logger.debug("Loading bundle %s.carl", filename)
+            metadata, arrays = load_bundle(filename + ".carl")
+            settings = metadata["settings"]
+            scaling = {
+                name[len("scaling/"):]: np.array(value) for name, value in arrays.items() if name.startswith("scaling/")
+            }
+            state_dict = OrderedDict(
+                (name[len("state_dict/"):], torch.from_numpy(np.array(value)))
+                for name, value in arrays.items()
+                if name.startswith("state_dict/")
+            )
+            if metadata.get("calibration") is not None:
+                calibration_arrays = OrderedDict(
+                    (name[len("calibration/"):], value) for name, value in arrays.items() if name.startswith("calibration/")
+                )
+                self.calibration = (metadata["calibration"], calibration_arrays)
+            else:
+                self.calibration = None
+        else:
+            logger.debug("Loading settings from %s_settings.json", filename)
+            with open(filename + "_settings.json", "r") as f:
+                settings = json.load(f)
+            scaling = {}
+            for name in ["means", "stds", "mins", "maxs"]:
+                try:
+                    scaling[name] = np.load(filename + "_x_" + name + ".npy")
+                except FileNotFoundError:
+                    pass
+            logger.debug("Loading state dictionary from %s_state_dict.pt", filename)
+            state_dict = torch.load(filename + "_state_dict.pt", map_location="cpu")
+            self.calibration = None
+
+        # Create model
         self._unwrap_settings(settings)
         self._create_model()
 
         # Load scaling
-        try:
-            self.x_scaling_means = np.load(filename + "_x_means.npy")
-            self.x_scaling_stds =  np.load(filename + "_x_stds.npy")
-            self.x_scaling_mins =  np.load(filename + "_x_mins.npy")
-            self.x_scaling_maxs =  np.load(filename + "_x_maxs.npy")
+        if len(scaling) == 4:
+            self.x_scaling_means = scaling["means"]
+            self.x_scaling_stds = scaling["stds"]
+            self.x_scaling_mins = scaling["mins"]
+            self.x_scaling_maxs = scaling["maxs"]
             logger.debug(
                 "  Found input scaling information: means %s, stds %s, mins %s, maxs %s  ", self.x_scaling_means, self.x_scaling_stds, self.x_scaling_mins, self.x_scaling_maxs
             )
-        except FileNotFoundError:
+        else:
             logger.warning("Scaling information not found in %s", filename)
             self.x_scaling_means = None
             self.x_scaling_stds = None
@@ -239,8 +248,187 @@ class Estimator(object):
             self.x_scaling_maxs = None
 
         # Load state dict
-        logger.debug("Loading state dictionary from %s_state_dict.pt", filename)
-        self.model.load_state_dict(torch.load(filename + "_state_dict.pt", map_location="cpu"))
+        missing_keys, unexpected_keys = self.model.load_state_dict(state_dict, strict=False)
+        missing_keys = [key for key in missing_keys if not key.startswith("input_scaling.")]
+        if missing_keys or unexpected_keys:
+            raise RuntimeError(
+                "State dictionary does not match model: missing {}, unexpected {}".format(missing_keys, unexpected_keys)
+            )
+
+        # Models saved before the scaling was part of the network get it from the scaling files
+        if "input_scaling.shift" not in state_dict:
+            logger.debug("No input scaling layer in state dictionary, using the saved scaling information")
+            self._set_model_input_scaling()
+        self._float_model = None
+        if self.quantized:
+            logger.debug("Quantizing the linear layers to int8")
+            self._quantize_model()
+        self._ort_session = None
+
+    def model_checksum(self):
+        """
+        sha256 checksum of the settings, the weights and the input scaling of the model. The weights are only hashed
+        again when the model is replaced or one of its tensors is modified, which pyTorch tracks with a version
+        counter per tensor.
+        """
+        settings = json.dumps(self._wrap_settings(), sort_keys=True)
+        model = self._unquantized_model()
+        state_dict = model.state_dict()
+        versions = [(key, value._version) for key, value in state_dict.items()]
+        if self._model_checksum is not None:
+            cached_model, cached_settings, cached_versions, checksum = self._model_checksum
+            if cached_model is model and cached_settings == settings and cached_versions == versions:
+                return checksum
+
+        checksum = hashlib.sha256(settings.encode("utf-8"))
+        for key, value in state_dict.items():
+            checksum.update(key.encode("utf-8"))
+            checksum.update(value.detach().cpu().numpy().tobytes())
+        checksum = checksum.hexdigest()
+        self._model_checksum = (model, settings, versions, checksum)
+        return checksum
+
+    def onnx_session(self, n_threads=None, n_inter_threads=1):
+        """
+        Returns an onnxruntime InferenceSession of the current model. The model is exported in memory with a dynamic
+        batch dimension, and the session is cached until the model is trained or loaded again.
+        Parameters
+        ----------
+        n_threads : int or None, optional
+            Number of intra-op threads. If None, the number of available CPUs. Default value: None.
+        n_inter_threads : int, optional
+            Number of inter-op threads. The MLP is a chain of operators, so more than one rarely helps.
+            Default value: 1.
+        Returns
+        -------
+        session : onnxruntime.InferenceSession
+        """
+        if self.model is None:
+            raise ValueError("No model -- train or load model before evaluating it!")
+
+        if n_threads is None:
+            n_threads = available_cpus()
+        if self._ort_session is not None and self._ort_session_threads == (n_threads, n_inter_threads):
+            return self._ort_session
+
+        logger.debug("Creating onnxruntime session with %s intra-op and %s inter-op threads", n_threads, n_inter_threads)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = n_threads
+        options.inter_op_num_threads = n_inter_threads
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self._ort_session = ort.InferenceSession(self._export_onnx(quantized=self.quantized), options)
+        self._ort_session_threads = (n_threads, n_inter_threads)
+        return self._ort_session
+
+    def export_onnx(self, filename, metaData=None, quantized=False):
+        """
+        Exports the model to a single onnx file that accepts batches of any size. The metadata (the entries of
+        metaData, the observables, the features and the input scaling) is attached to the exported graph before it
+        is written, so the file is serialised once. Constant folding is done by the exporter; onnxruntime applies its
+        own graph optimisations when the file is loaded.
+        Parameters
+        ----------
+        filename : str
+            Path of the .onnx file.
+        metaData : dict or None, optional
+            Metadata per observable, as returned by `Loader.loading()`. Default value: None.
+        quantized : bool, optional
+            If True, the weights of the exported graph are dynamically quantized to int8 with onnxruntime.
+            Default value: False.
+        Returns
+        -------
+            None
+        """
+        if self.model is None:
+            raise ValueError("No model -- train or load model before exporting it!")
+
+        logger.debug("Exporting model to %s", filename)
+        create_missing_folders([os.path.dirname(filename)])
+
+        model = onnx.load_from_string(self._export_onnx(quantized=quantized))
+        metadata = {} if metaData is None else {key: str(value) for key, value in metaData.items()}
+        if metaData is not None:
+            metadata["observables"] = json.dumps(list(metaData.keys()))
+        metadata["features"] = json.dumps(self.features)
+        metadata["scaling"] = self.scaling
+        metadata["quantized"] = json.dumps(quantized)
+        shift, scale = self._input_scaling_parameters()
+        if shift is not None:
+            metadata["scaling_shift"] = json.dumps(shift.tolist())
+            metadata["scaling_scale"] = json.dumps(scale.tolist())
+        for key, value in metadata.items():
+            meta = model.metadata_props.add()
+            meta.key = key
+            meta.value = value
+        onnx.save(model, filename)
+        logger.debug("  Embedded metadata: %s", list(metadata.keys()))
+
+    def _export_onnx(self, quantized=False):
+        """
+        Exports the model in float precision to a serialized onnx graph with a dynamic batch dimension. If quantized
+        is True, the weights of the graph are then dynamically quantized to int8. The model is exported from a CPU
+        copy, so the device, precision and training mode of the estimator's model are left untouched.
+        """
+        model = copy.deepcopy(self._unquantized_model()).to(torch.device("cpu"), torch.float)
+        model.eval()
+        dummy_input = torch.zeros((1, self.n_observables), dtype=torch.float)
+        # Ensembles emit outputs of shape (n_members, n_batch, 1)
+        batch_axis = 0 if getattr(model, "n_members", None) is None else 1
+
+        f = io.BytesIO()
+        torch.onnx.export(
+            model,
+            dummy_input,
+            f,
+            export_params=True,
+            do_constant_folding=True,
+            input_names=["input"],
+            output_names=["r_hat", "s_hat"],
+            dynamic_axes={"input": {0: "batch"}, "r_hat": {batch_axis: "batch"}, "s_hat": {batch_axis: "batch"}},
+        )
+        if not quantized:
+            return f.getvalue()
+
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        folder = tempfile.mkdtemp()
+        try:
+            float_filename = os.path.join(folder, "float.onnx")
+            int8_filename = os.path.join(folder, "int8.onnx")
+            with open(float_filename, "wb") as float_file:
+                float_file.write(f.getvalue())
+            quantize_dynamic(float_filename, int8_filename, weight_type=QuantType.QInt8)
+            with open(int8_filename, "rb") as int8_file:
+                return int8_file.read()
+        finally:
+            for name in os.listdir(folder):
+                os.remove(os.path.join(folder, name))
+            os.rmdir(folder)
+
+    def _quantize_model(self):
+        """ Replaces the model by a copy with dynamically int8 quantized linear layers, for CPU inference """
+        if self.n_ensemble > 1:
+            raise NotImplementedError("Quantization is not supported for ensembles")
+        self._float_model = self.model.to(torch.device("cpu"), torch.float)
+        self.model = torch.quantization.quantize_dynamic(
+            copy.deepcopy(self._float_model), {nn.Linear}, dtype=torch.qint8
+        )
+        self.model.eval()
+        self.quantized = True
+        self._ort_session = None
+
+    def _dequantize_model(self):
+        """ Restores the float model """
+        if self.quantized:
+            self.model = self._float_model
+            self._float_model = None
+            self.quantized = False
+            self._ort_session = None
+
+    def _unquantized_model(self):
+        return self._float_model if self.quantized else self.model
 
     def initialize_input_transform(self, x, transform=True, overwrite=True):
         if self.x_scaling_stds is not None and self.x_scaling_means is not None and self.x_scaling_mins is not None and self.x_scaling_maxs is not None and not overwrite:
@@ -255,7 +443,7 @@ class Estimator(object):
             self.x_scaling_maxs = np.max(x, axis=0)
         else:
             logger.info("Disabling input rescaling")
-            n_parameters = x.shape[0]
+            n_parameters = x.shape[1]
 
             self.x_scaling_means = np.zeros(n_parameters)
             self.x_scaling_stds = np.ones(n_parameters)
@@ -264,7 +452,7 @@ class Estimator(object):
 
     def _transform_inputs(self, x, scaling = "minmax"):
         if scaling == "standard":    
-            print("<base.py::_transform_inputs()>::   Doing Standard Scaling")
+            logger.debug("Doing standard scaling")
             #Check for standard deviation = 0 and none values
             if self.x_scaling_means is not None and self.x_scaling_stds is not None:
                 if isinstance(x, torch.Tensor):
@@ -276,7 +464,7 @@ class Estimator(object):
             else:
                 x_scaled = x
         else:
-            print("<base.py::_transform_inputs()>::   Doing min-max scaling")
+            logger.debug("Doing min-max scaling")
             # Check for none and 0 values
             if self.x_scaling_mins is not None and self.x_scaling_maxs is not None:
                 if isinstance(x, torch.Tensor):
@@ -291,14 +479,46 @@ class Estimator(object):
                 x_scaled = x
         return x_scaled
 
+    def _input_scaling_parameters(self):
+        """
+        Shift and scale of the input scaling layer, such that (x - shift) * scale reproduces the min-max or standard
+        scaling of `_transform_inputs()` for the features used by the network.
+        """
+        if self.scaling == "standard":
+            if self.x_scaling_means is None or self.x_scaling_stds is None:
+                return None, None
+            shift = np.asarray(self.x_scaling_means, dtype=np.float64)
+            scale = 1.0 / np.asarray(self.x_scaling_stds, dtype=np.float64)
+        else:
+            if self.x_scaling_mins is None or self.x_scaling_maxs is None:
+                return None, None
+            shift = np.asarray(self.x_scaling_mins, dtype=np.float64)
+            diff = np.asarray(self.x_scaling_maxs, dtype=np.float64) - shift
+            scale = np.divide(1.0, diff, out=np.zeros_like(diff), where=diff != 0)
+
+        if self.features is not None:
+            shift, scale = shift[self.features], scale[self.features]
+        return shift, scale
+
+    def _set_model_input_scaling(self):
+        shift, scale = self._input_scaling_parameters()
+        if shift is None:
+            logger.debug("No input scaling information, using identity scaling layer")
+            shift, scale = np.zeros(self.n_observables), np.ones(self.n_observables)
+        self.model.input_scaling.set_scaling(shift, scale)
+
     def _wrap_settings(self):
         settings = {
             "n_observables": self.n_observables,
             "n_parameters": self.n_parameters,
             "features": self.features,
+            "observables": self.observables,
             "n_hidden": list(self.n_hidden),
             "activation": self.activation,
             "dropout_prob": self.dropout_prob,
+            "n_ensemble": self.n_ensemble,
+            "scaling": self.scaling,
+            "quantized": self.quantized,
         }
         return settings
 
@@ -328,6 +548,15 @@ class Estimator(object):
                 "Can't find dropout probability in model file. Probably this file was created with an older"
             )
 
+        try:
+            self.n_ensemble = int(settings["n_ensemble"])
+        except KeyError:
+            self.n_ensemble = 1
+
+        self.scaling = str(settings.get("scaling", "minmax"))
+        self.observables = settings.get("observables")
+        self.quantized = bool(settings.get("quantized", False))
+
     def _create_model(self):
         raise NotImplementedError
 
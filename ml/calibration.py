@@ -7,7 +7,7 @@ from sklearn.utils import column_or_1d
 from sklearn.preprocessing import LabelEncoder
 
 from .utils.tools import load_and_check
-from .distributions import Histogram
+from .distributions import Histogram, bin_indices
 from .utils.tools import create_missing_folders, load_and_check
 from .ratio import RatioEstimator
 
@@ -28,21 +28,44 @@ class CalibratedClassifier():
         self.interpolation = interpolation
         self.variable_width = variable_width
         self.model = model
-    def fit(self, X, y):
+    @classmethod
+    def from_model(cls, model):
+        """Restore the calibration stored in the bundle of a loaded model.
+        Parameters
+        ----------
+        * `model` [RatioEstimator]:
+            Model loaded from a bundle saved with a calibrator.
+        Returns
+        -------
+        * `calibrated` [CalibratedClassifier]:
+            The fitted calibrated classifier.
+        """
+        if model.calibration is None:
+            raise ValueError("Model has no stored calibration")
+        state, arrays = model.calibration
+        calibrated = cls(model, method=state["method"], bins=state["bins"],
+                         interpolation=state["interpolation"],
+                         variable_width=state["variable_width"])
+        calibrated.classes_ = np.array(state["classes"])
+        calibrated.calibrator = HistogramCalibrator._unwrap_state(state["calibrator"], arrays)
+        return calibrated
+
+    def fit(self, X=None, y=None, T=None):
         """Fit the calibrated model.
         Parameters
         ----------
         * `X` [array-like, shape=(n_samples, n_features)]:
-            Training data.
+            Training data. Not needed if `T` is given.
         * `y` [array-like, shape=(n_samples,)]:
             Target values.
+        * `T` [array-like, shape=(n_samples,), optional]:
+            Precomputed classifier outputs s_hat of `X`.
         Returns
         -------
         * `self` [object]:
             `self`.
         """
         # Check inputs
-        X = load_and_check(X)
         y = load_and_check(y)
         y = column_or_1d(y)
         label_encoder = LabelEncoder()
@@ -54,31 +77,65 @@ class CalibratedClassifier():
 
         # Calibrator
         cal = HistogramCalibrator(bins=self.bins, interpolation=self.interpolation,variable_width=self.variable_width)
-        _, T = self.model.evaluate(X)
+        T = self._scores(X, T)
 
         cal.fit(T, y)
         self.calibrator = cal
         return self
 
-    def predict(self, X):
+    def fit_predict(self, X=None, y=None, T=None, chunk_size=1000000):
+        """Fit the calibrated model and calibrate the same sample, evaluating
+        the classifier only once.
+        Parameters
+        ----------
+        * `X` [array-like, shape=(n_samples, n_features)]:
+            Training data. Not needed if `T` is given.
+        * `y` [array-like, shape=(n_samples,)]:
+            Target values.
+        * `T` [array-like, shape=(n_samples,), optional]:
+            Precomputed classifier outputs s_hat of `X`.
+        Returns
+        -------
+        * `p0`, `p1`, `r` [arrays, shape=(n_samples,)]:
+            As returned by `predict`.
+        """
+        T = self._scores(X, T)
+        self.fit(y=y, T=T)
+        return self.predict(T=T, chunk_size=chunk_size)
+
+    def predict(self, X=None, T=None, chunk_size=1000000):
         """Predict the targets for `X`.
         Can be different from the predictions of the uncalibrated classifier.
         Parameters
         ----------
         * `X` [array-like, shape=(n_samples, n_features)]:
-            The samples.
+            The samples. Not needed if `T` is given.
+        * `T` [array-like, shape=(n_samples,), optional]:
+            Precomputed classifier outputs s_hat of `X`.
+        * `chunk_size` [int]:
+            Number of scores calibrated at once.
         Returns
         -------
-        * `y` [array, shape=(n_samples,)]:
-            The predicted class.
+        * `p0`, `p1` [arrays, shape=(n_samples,)]:
+            The calibrated probabilities of the two classes (values of 0 or
+            infinity are replaced by 1).
+        * `r` [array, shape=(n_samples,)]:
+            The calibrated ratio p0 / p1.
         """
-        X = load_and_check(X)
-        _, s_hat = self.model.evaluate(X)
-        p = self.predict_proba(X, s_hat)
-        p[p == np.inf] = 1
-        p[p == 0] = 1       
-        return p[:, 0], p[:, 1], np.divide(p[:, 0], p[:, 1])
-
+        T = column_or_1d(self._scores(X, T))
+        n = len(T)
+        p0 = np.empty(n)
+        p1 = np.empty(n)
+        r = np.empty(n)
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            p0_chunk, p1_chunk = p0[start:stop], p1[start:stop]
+            p1_chunk[:] = self.calibrator.predict(T[start:stop])
+            np.subtract(1., p1_chunk, out=p0_chunk)
+            for p in (p0_chunk, p1_chunk):
+                p[(p == np.inf) | (p == 0)] = 1
+            np.divide(p0_chunk, p1_chunk, out=r[start:stop])
+        return p0, p1, r
 
     def predict_proba(self, X, s_hat):
         """Predict the posterior probabilities of classification for `X`.
@@ -86,16 +143,97 @@ class CalibratedClassifier():
         ----------
         * `X` [array-like, shape=(n_samples, n_features)]:
             The samples.
+        * `s_hat` [array-like, shape=(n_samples,)]:
+            The classifier outputs of `X`.
         Returns
         -------
         * `probas` [array, shape=(n_samples, n_classes)]:
             The predicted probabilities.
         """
-        p = np.zeros((len(X), 2))
-        p[:, 1] += self.calibrator.predict(s_hat)
-        p[:, 0] = 1. - p[:, 1]
+        p = np.empty((len(s_hat), 2))
+        p[:, 1] = self.calibrator.predict(s_hat)
+        np.subtract(1., p[:, 1], out=p[:, 0])
         return p
 
+    def _scores(self, X, T):
+        """Classifier outputs, evaluated once in chunks unless precomputed."""
+        if T is not None:
+            return load_and_check(T)
+        if X is None:
+            raise ValueError("Either X or the classifier outputs T are needed")
+        # File names are passed on, so that the evaluation loads them itself and the cache can use their fingerprint
+        _, T = self.model.evaluate(X)
+        return T
+
+    def fit_streaming(self, X, y, sample_weight=None, chunk_size=1000000, range=(0., 1.)):
+        """Fit the calibrated model chunk by chunk in bounded memory, with a
+        `StreamingHistogramCalibrator` of `self.bins` equally wide bins.
+        Only `method="histogram"` with an integer number of bins, no
+        interpolation and fixed bin widths is supported, other settings raise
+        a `ValueError`.
+        Parameters
+        ----------
+        * `X` [array-like or str, shape=(n_samples, n_features)]:
+            Training data, memory mapped if given as file name.
+        * `y` [array-like or str, shape=(n_samples,)]:
+            Target values, 0 or 1.
+        * `sample_weight` [array-like or str, shape=(n_samples,), optional]:
+            Event weights.
+        * `chunk_size` [int]:
+            Number of events evaluated and accumulated at once.
+        * `range` [(lower, upper) or None]:
+            Bounds of the histograms. If `None`, they are determined in a
+            first pass, which evaluates the classifier twice.
+        Returns
+        -------
+        * `self` [object]:
+            `self`.
+        """
+        if self.method != "histogram":
+            raise ValueError("Streaming calibration only supports the histogram method, not {}".format(self.method))
+        if not isinstance(self.bins, (int, np.integer)):
+            raise ValueError("Streaming calibration needs an integer number of bins, not {}".format(self.bins))
+        if self.interpolation is not None or self.variable_width:
+            raise ValueError("Streaming calibration supports neither interpolation nor variable bin widths")
+
+        X = np.load(X, mmap_mode="r") if isinstance(X, str) else X
+        y = np.load(y, mmap_mode="r") if isinstance(y, str) else y
+        if isinstance(sample_weight, str):
+            sample_weight = np.load(sample_weight, mmap_mode="r")
+        y = y.reshape(-1)
+
+        def scores():
+            for start in np.arange(0, len(X), chunk_size):
+                stop = min(start + chunk_size, len(X))
+                # Chunks bypass the evaluation cache, like all chunked evaluations
+                _, T = self.model.evaluate(np.asarray(X[start:stop]), cache=False)
+                yield start, stop, T
+
+        calibrator = StreamingHistogramCalibrator(bins=int(self.bins), range=range)
+        if range is None:
+            for _, _, T in scores():
+                calibrator.update_range(T)
+        for start, stop, T in scores():
+            w = None if sample_weight is None else np.asarray(sample_weight[start:stop]).reshape(-1)
+            calibrator.partial_fit(T, y[start:stop], sample_weight=w)
+
+        self.classes_ = np.array([0, 1])
+        self.calibrator = calibrator.to_histogram_calibrator()
+        return self
+
+    def _wrap_state(self):
+        """State of the fitted calibration as JSON metadata and named arrays, stored in model bundles."""
+        calibrator_state, arrays = self.calibrator._wrap_state()
+        state = {
+            "method": self.method,
+            "bins": self.bins,
+            "interpolation": self.interpolation,
+            "variable_width": self.variable_width,
+            "classes": self.classes_.tolist(),
+            "calibrator": calibrator_state,
+        }
+        return state, arrays
+
 
 class HistogramCalibrator():
     """Probability calibration through density estimation with histograms."""
@@ -160,8 +298,62 @@ class HistogramCalibrator():
                                      variable_width=self.variable_width)
         self.calibrator0.fit(t0.reshape(-1, 1))
         self.calibrator1.fit(t1.reshape(-1, 1))
+        self._build_table()
         return self
 
+    def _build_table(self):
+        """Precompute p1 / (p0 + p1) per bin on the union of the edges of both
+        histograms, which is exact for piecewise constant densities. Not used
+        with interpolation."""
+        if self.interpolation:
+            self.edges_ = self.table_ = None
+            return
+        edges = np.union1d(self.calibrator0.edges_[0], self.calibrator1.edges_[0])
+        # Every bin is represented by its center, the underflow and overflow
+        # bins by values beyond the finite edges
+        points = np.empty(len(edges) - 1)
+        points[0] = -np.inf
+        points[1:-1] = 0.5 * (edges[1:-2] + edges[2:-1])
+        points[-1] = np.nextafter(edges[-2], np.inf)
+        self.edges_ = edges
+        self.table_ = self._ratio(points)
+
+    def _ratio(self, T):
+        T = T.reshape(-1, 1)
+        num = self.calibrator1.pdf(T)
+        den = self.calibrator0.pdf(T) + num
+        return np.divide(num, den, out=np.full(len(T), 0.5), where=den != 0)
+
+    def _wrap_state(self):
+        state = {"bins": self.bins, "range": self.range, "eps": self.eps,
+                 "interpolation": self.interpolation,
+                 "variable_width": self.variable_width}
+        arrays = {}
+        for i, histogram in enumerate([self.calibrator0, self.calibrator1]):
+            state["bins%d" % i] = histogram.bins
+            state["range%d" % i] = None if histogram.range is None else [
+                [float(bound) for bound in bounds] for bounds in histogram.range]
+            arrays["histogram%d" % i] = histogram.histogram_
+            arrays["edges%d" % i] = histogram.edges_[0]
+        return state, arrays
+
+    @classmethod
+    def _unwrap_state(cls, state, arrays):
+        calibrator = cls(bins=state["bins"], range=state["range"], eps=state["eps"],
+                         interpolation=state["interpolation"],
+                         variable_width=state["variable_width"])
+        for i in range(2):
+            histogram = Histogram(bins=state["bins%d" % i], range=state["range%d" % i],
+                                  interpolation=state["interpolation"],
+                                  variable_width=state["variable_width"])
+            histogram.histogram_ = np.array(arrays["histogram%d" % i])
+            histogram.edges_ = [np.array(arrays["edges%d" % i])]
+            histogram.ndim_ = 1
+            histogram._set_interpolation()
+            setattr(calibrator, "calibrator%d" % i, histogram)
+        calibrator._build_table()
+        return calibrator
+
     def predict(self, T):
         """Calibrate data.
         Parameters
@@ -173,10 +365,123 @@ class HistogramCalibrator():
         * `Tt` [array, shape=(n_samples,)]:
             Calibrated data.
         """
-        T = column_or_1d(T).reshape(-1, 1)
-        num = self.calibrator1.pdf(T)
-        den = self.calibrator0.pdf(T) + self.calibrator1.pdf(T)
-        p = num / den
-        p[den == 0] = 0.5
+        T = column_or_1d(T)
+        if getattr(self, "table_", None) is None:
+            return self._ratio(T)
+
+        # One lookup in the precomputed table, in chunks that stay in cache
+        p = np.empty(len(T))
+        for start in range(0, len(T), 65536):
+            stop = min(start + 65536, len(T))
+            p[start:stop] = self.table_[bin_indices(T[start:stop], self.edges_)]
         return p
         
+
+
+class StreamingHistogramCalibrator():
+    """Histogram calibration accumulated chunk by chunk, in bounded memory.
+    Partial calibrators with the same edges (e.g. fitted in different
+    processes) can be merged."""
+
+    def __init__(self, bins=100, range=(0., 1.), eps=0.1):
+        """Constructor.
+        Parameters
+        ----------
+        * `bins` [integer]:
+            The number of equally wide bins.
+        * `range` [(lower, upper) or None]:
+            The lower and upper bounds. The default covers all classifier
+            outputs. If `None`, the bounds are determined in a first pass with
+            `update_range`, with a margin of `eps` like `HistogramCalibrator`.
+        * `eps` [float]:
+            The margin to the lower and upper bounds found by `update_range`.
+        """
+        self.bins = bins
+        self.range = range
+        self.eps = eps
+        self.t_min_ = np.inf
+        self.t_max_ = -np.inf
+        self.edges_ = None
+        self.counts_ = None
+
+    def update_range(self, T):
+        """First pass: track the minimum and maximum of the chunk `T`."""
+        T = column_or_1d(T)
+        if len(T) > 0:
+            self.t_min_ = min(self.t_min_, np.min(T))
+            self.t_max_ = max(self.t_max_, np.max(T))
+        return self
+
+    def _make_edges(self):
+        if self.range is not None:
+            t_min, t_max = self.range
+        elif self.t_min_ <= self.t_max_:
+            t_min = max(0, self.t_min_ - self.eps)
+            t_max = min(1, self.t_max_ + self.eps)
+        else:
+            raise ValueError("No range given and no first pass with update_range")
+        edges = np.linspace(t_min, t_max, self.bins + 1)
+        return np.concatenate([[-np.inf], edges, [np.inf]])
+
+    def partial_fit(self, T, y, sample_weight=None):
+        """Accumulate the weighted counts per class of the chunk `T`, `y`.
+        Parameters
+        ----------
+        * `T` [array-like, shape=(n_samples,)]:
+            Classifier outputs.
+        * `y` [array-like, shape=(n_samples,)]:
+            Class labels, 0 or 1.
+        * `sample_weight` [array-like, shape=(n_samples,), optional]:
+            Event weights.
+        Returns
+        -------
+        * `self` [object]:
+            `self`.
+        """
+        T = column_or_1d(T)
+        y = column_or_1d(y)
+        if self.counts_ is None:
+            self.edges_ = self._make_edges()
+            self.counts_ = np.zeros((2, len(self.edges_) - 1))
+        edges = self.edges_
+        indices = bin_indices(T, edges)
+        for label in [0, 1]:
+            mask = y == label
+            weights = None if sample_weight is None else column_or_1d(sample_weight)[mask]
+            self.counts_[label] += np.bincount(indices[mask], weights=weights, minlength=len(edges) - 1)
+        return self
+
+    def merge(self, other):
+        """Add the counts of another partial calibrator with the same edges."""
+        if other.counts_ is None:
+            return self
+        if self.counts_ is None:
+            self.edges_, self.counts_ = other.edges_, other.counts_.copy()
+            return self
+        if not np.array_equal(self.edges_, other.edges_):
+            raise ValueError("Cannot merge calibrators with different edges")
+        self.counts_ += other.counts_
+        return self
+
+    def to_histogram_calibrator(self):
+        """The equivalent fitted `HistogramCalibrator`, with the densities
+        normalised as by `np.histogramdd` and empty underflow and overflow bins.
+        It can be used and stored as calibrator of a `CalibratedClassifier`."""
+        if self.counts_ is None:
+            raise ValueError("Calibrator has not been fitted")
+        edges = self.edges_
+        widths = np.diff(edges[1:-1])
+        calibrator = HistogramCalibrator(bins=self.bins, range=[tuple(edges[[1, -2]])], eps=self.eps)
+        for label in [0, 1]:
+            counts = self.counts_[label][1:-1]
+            total = np.sum(counts)
+            histogram = np.zeros(len(edges) - 1)
+            if total > 0:
+                histogram[1:-1] = counts / total / widths
+            calibrator_histogram = Histogram(bins=self.bins, range=calibrator.range)
+            calibrator_histogram.histogram_ = histogram
+            calibrator_histogram.edges_ = [edges]
+            calibrator_histogram.ndim_ = 1
+            setattr(calibrator, "calibrator%d" % label, calibrator_histogram)
+        calibrator._build_table()
+        return calibrator
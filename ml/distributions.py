@@ -6,6 +6,37 @@ from scipy.interpolate import interp1d
 
 
 
+def bin_indices(x, edges):
+    """Bin indices of `x` for `edges` with infinite outer edges, as used by
+    `Histogram`. The upper edge of the last finite bin is inclusive. For
+    equally wide bins the index is computed arithmetically, otherwise with a
+    single binary search.
+    Parameters
+    ----------
+    * `x` [array, shape=(n_samples,)]:
+        The values.
+    * `edges` [array, shape=(n_edges,)]:
+        The edges, starting with -inf and ending with inf.
+    Returns
+    -------
+    * `indices` [array of int, shape=(n_samples,)]:
+        The bin indices, from 0 (underflow) to n_edges - 2 (overflow).
+    """
+    finite = edges[1:-1]
+    n_bins = len(finite) - 1
+    widths = np.diff(finite)
+    if n_bins > 0 and np.all(widths > 0) and np.allclose(widths, widths[0], rtol=1e-9, atol=0.):
+        indices = np.floor((x - finite[0]) * (1. / widths[0]))
+        np.clip(indices, -1, n_bins - 1, out=indices)
+        indices = indices.astype(np.intp) + 1
+        indices[~(x <= finite[-1])] = n_bins + 1
+        return indices
+
+    indices = np.searchsorted(edges, x, side="right") - 1
+    indices[x == finite[-1]] -= 1
+    return indices
+
+
 class Histogram():
     """N-dimensional histogram."""
 
@@ -39,13 +70,7 @@ class Histogram():
         all_indices = []
 
         for j in range(X.shape[1]):
-            indices = np.searchsorted(self.edges_[j],
-                                      X[:, j],
-                                      side="right") - 1
-
-            # For the last bin, the upper is inclusive
-            indices[X[:, j] == self.edges_[j][-2]] -= 1
-            all_indices.append(indices)
+            all_indices.append(bin_indices(X[:, j], self.edges_[j]))
         return self.histogram_[tuple(all_indices)]
 
     def nll(self, X, **kwargs):
@@ -88,7 +113,15 @@ class Histogram():
             e[j] = np.insert(e[j], 0, -np.inf)
             e[j] = np.insert(e[j], len(e[j]), np.inf)
 
-        if X.shape[1] == 1 and self.interpolation:
+        self.histogram_ = h
+        self.edges_ = e
+        self.ndim_ = X.shape[1]
+        self._set_interpolation()
+        return self
+
+    def _set_interpolation(self):
+        if self.ndim_ == 1 and self.interpolation:
+            e, h = self.edges_, self.histogram_
             inputs = e[0][2:-1] - (e[0][2] - e[0][1]) / 2.
             inputs[0] = e[0][1]
             inputs[-1] = e[0][-2]
@@ -97,10 +130,6 @@ class Histogram():
                                            kind=self.interpolation,
                                            bounds_error=False,
                                            fill_value=0.)
-        self.histogram_ = h
-        self.edges_ = e
-        self.ndim_ = X.shape[1]
-        return self
 
     @property
     def ndim(self):
@@ -3,10 +3,10 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import logging
 import numpy as np
 import torch
-from torch import tensor
 from sklearn.metrics import roc_curve, auc, accuracy_score, confusion_matrix, classification_report
 
 from .models import RatioModel
+from .functions import inference_mode
 import matplotlib.pyplot as plt
 
 logger = logging.getLogger(__name__)
@@ -17,34 +17,75 @@ def evaluate_ratio_model(
     run_on_gpu=True,
     double_precision=False,
     return_grad_x=False,
+    chunk_size=100000,
+    features=None,
 ):
+    """
+    Evaluates the model in chunks of `chunk_size` events with bounded memory. Every chunk is a zero-copy view of
+    `xs` (numpy arrays and memory maps), only converted to the model precision and restricted to `features` chunk by
+    chunk, and the results are written into preallocated output arrays. Ensemble models return one row per member.
+    """
     # CPU or GPU?
     run_on_gpu = run_on_gpu and torch.cuda.is_available()
     device = torch.device("cuda" if run_on_gpu else "cpu")
     dtype = torch.double if double_precision else torch.float
+    np_dtype = np.float64 if double_precision else np.float32
 
-    # Prepare data
+    # Prepare output
     n_xs = len(xs)
-    xs = torch.stack([tensor(i) for i in xs])
+    n_members = getattr(model, "n_members", None)
+    shape = (n_xs,) if n_members is None else (n_members, n_xs)
+    r_hat = np.empty(shape, dtype=np_dtype)
+    s_hat = np.empty(shape, dtype=np_dtype)
 
     model = model.to(device, dtype)
-    xs = xs.to(device, dtype)
-    with torch.no_grad():
-        model.eval()
-
-        r_hat, s_hat  = model(xs)
-        # Do we need this as ml/models.py::forward() defined implicitely that the output of the network is:
-        #      s_hat = torch.sigmoid(s_hat)  where s_hat at this point is the network last layer
-        #      r_hat = (1-s_hat) / s_hat = p_{1}(x) / p_{0}(x)
-        s_hat = torch.sigmoid(s_hat) 
-        # Copy back tensors to CPU
-        if run_on_gpu:
-            r_hat = r_hat.cpu()
-            s_hat = s_hat.cpu()
-
-        # Get data and return
-        r_hat = r_hat.detach().numpy().flatten()
-        s_hat = s_hat.detach().numpy().flatten()
+    model.eval()
+    with inference_mode():
+        for start in range(0, n_xs, chunk_size):
+            stop = min(start + chunk_size, n_xs)
+            x_chunk = xs[start:stop]
+            if features is not None:
+                x_chunk = x_chunk[:, features]
+            x_chunk = torch.from_numpy(np.ascontiguousarray(x_chunk)).to(device, dtype, non_blocking=True)
+
+            # The model emits s_hat = sigmoid(logit) and r_hat = (1-s_hat) / s_hat = exp(-logit)
+            r_chunk, s_chunk = model(x_chunk)
+            r_hat[..., start:stop] = r_chunk.view(shape[:-1] + (-1,)).cpu().numpy()
+            s_hat[..., start:stop] = s_chunk.view(shape[:-1] + (-1,)).cpu().numpy()
+
+    return r_hat, s_hat
+
+def evaluate_ratio_onnx(session, xs, chunk_size=100000, features=None):
+    """
+    Evaluates an onnxruntime InferenceSession of an exported model in chunks of `chunk_size` events. The float32
+    input buffer and the output arrays are allocated once, every chunk of `xs` is copied into the input buffer and
+    the results are written into the outputs. Ensemble models return one row per member.
+    """
+    input_name = session.get_inputs()[0].name
+    output_names = [output.name for output in session.get_outputs()]
+
+    # Prepare input and output
+    n_xs = len(xs)
+    n_inputs = len(features) if features is not None else xs.shape[1]
+    output_shape = session.get_outputs()[0].shape
+    n_members = output_shape[0] if len(output_shape) == 3 else None
+    shape = (n_xs,) if n_members is None else (n_members, n_xs)
+    r_hat = np.empty(shape, dtype=np.float32)
+    s_hat = np.empty(shape, dtype=np.float32)
+    x_buffer = np.empty((min(chunk_size, n_xs), n_inputs), dtype=np.float32)
+
+    for start in range(0, n_xs, chunk_size):
+        stop = min(start + chunk_size, n_xs)
+        x_chunk = xs[start:stop]
+        if features is not None:
+            x_chunk = x_chunk[:, features]
+        x_input = x_buffer[: stop - start]
+        np.copyto(x_input, x_chunk, casting="unsafe")
+
+        r_chunk, s_chunk = session.run(output_names, {input_name: x_input})
+        r_hat[..., start:stop] = r_chunk.reshape(shape[:-1] + (-1,))
+        s_hat[..., start:stop] = s_chunk.reshape(shape[:-1] + (-1,))
+
     return r_hat, s_hat
 
 def evaluate_performance_model(
@@ -54,28 +95,25 @@ def evaluate_performance_model(
     run_on_gpu=True,
     double_precision=False,
     return_grad_x=False,
+    chunk_size=100000,
+    features=None,
 ):
-    # CPU or GPU?
-    run_on_gpu = run_on_gpu and torch.cuda.is_available()
-    device = torch.device("cuda" if run_on_gpu else "cpu")
-    dtype = torch.double if double_precision else torch.float
-
-    # Prepare data
-    n_xs = len(xs)
-    xs = torch.stack([tensor(i) for i in xs])
-
-    model = model.to(device, dtype)
-    xs = xs.to(device, dtype)
-
-    with torch.no_grad():
-        model.eval()
+    _, probs = evaluate_ratio_model(
+        model,
+        xs,
+        run_on_gpu=run_on_gpu,
+        double_precision=double_precision,
+        chunk_size=chunk_size,
+        features=features,
+    )
+    if probs.ndim == 2:
+        probs = probs.mean(axis=0)
+    ys = np.asarray(ys).reshape(-1)
 
-        _, logit  = model(xs)
-        probs = torch.sigmoid(logit)
-        y_pred = torch.round(probs)
-        print("confusion matrix ",confusion_matrix(ys, y_pred))
-        print(classification_report(ys, y_pred))
-        fpr, tpr, auc_thresholds = roc_curve(ys, y_pred)
+    y_pred = np.round(probs)
+    print("confusion matrix ",confusion_matrix(ys, y_pred))
+    print(classification_report(ys, y_pred))
+    fpr, tpr, auc_thresholds = roc_curve(ys, y_pred)
 
 def plot_roc_curve(fpr, tpr, label=None):
     plt.figure(figsize=(8,8))
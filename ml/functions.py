@@ -12,6 +12,9 @@ from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
+# torch.inference_mode only exists in newer pyTorch versions
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
 def get_activation(activation):
     if activation == "relu":
         return torch.relu
@@ -53,19 +56,19 @@ def get_optimizer(optimizer, nesterov_momentum):
     return opt, opt_kwargs
 
 
-def ratio_xe(s_hat, y_true, w):
-    # Original loss
-    #loss = BCEWithLogitsLoss()(s_hat, y_true) #sjiggins
-    
-    # New weighted loss functions - sjiggins
+def ratio_xe(logit, y_true, w):
+    # Weighted binary cross-entropy evaluated directly on the network logits (s_hat = sigmoid(logit)),
+    # fused into a single numerically stable kernel
     if w is None:
-        w = torch.ones(y_true.shape[0])
-    #assert w.dim() == 1, "Weights must be a rank 1 tensor"
-    #loss = (BCEWithLogitsLoss(reduction='none')(s_hat, y_true) * w / w.sum()).sum()  # First test
-    #loss = (BCEWithLogitsLoss()(s_hat, y_true) * w / w.sum()).sum()
-    #loss = (BCELoss(reduction='none')(s_hat, y_true) * w / w.sum()).sum()
-    #loss = (BCELoss(weight=w)(s_hat, y_true) * w / w.sum()).sum()
-    loss = BCELoss(weight=w)(s_hat, y_true)
+        w = torch.ones_like(y_true)
+    if logit.dim() == 3:
+        # Ensemble output of shape (n_members, n_batch, 1): sum of the independent member losses
+        n_members = logit.shape[0]
+        logit = logit.view(n_members, -1)
+        y_true = y_true.view(1, -1).expand_as(logit)
+        w = w.view(1, -1).expand_as(logit)
+        return n_members * F.binary_cross_entropy_with_logits(logit, y_true, weight=w)
+    loss = F.binary_cross_entropy_with_logits(logit, y_true.view_as(logit), weight=w.view_as(logit))
     return loss
 
 @contextmanager
@@ -0,0 +1,408 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import time
+import logging
+import multiprocessing
+import numpy as np
+import torch
+
+from .utils.tools import create_missing_folders, available_cpus, flatten_arrays
+from .utils.cache import data_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Model held by every worker process of parallel_evaluate
+_worker_estimator = None
+
+
+def _init_worker(model_filename, n_threads):
+    global _worker_estimator
+    from .ratio import RatioEstimator
+
+    torch.set_num_threads(n_threads)
+    _worker_estimator = RatioEstimator()
+    _worker_estimator.load(model_filename)
+
+
+def _evaluate_shard(task):
+    shard_id, filename, start, stop, output_dir, chunk_size = task
+    time_started = time.time()
+
+    x = np.load(filename, mmap_mode="r")
+    if x.ndim == 1:
+        x = x.reshape(-1, 1)
+    r_hat, s_hat = _worker_estimator.evaluate_ratio(x[start:stop], chunk_size=chunk_size)
+    return _save_shard(shard_id, filename, start, stop, output_dir, r_hat, s_hat, time.time() - time_started)
+
+
+def _save_shard(shard_id, filename, start, stop, output_dir, r_hat, s_hat, seconds):
+    r_hat_file = "shard_{:05d}_r_hat.npy".format(shard_id)
+    s_hat_file = "shard_{:05d}_s_hat.npy".format(shard_id)
+    np.save(os.path.join(output_dir, r_hat_file), r_hat)
+    np.save(os.path.join(output_dir, s_hat_file), s_hat)
+
+    return {
+        "shard": shard_id,
+        "input": filename,
+        "start": start,
+        "stop": stop,
+        "n_events": stop - start,
+        "r_hat": r_hat_file,
+        "s_hat": s_hat_file,
+        "seconds": seconds,
+    }
+
+
+def make_shards(inputs, shard_size=None):
+    """
+    Splits the input files into shards of at most `shard_size` rows (one shard per file if None).
+    Returns
+    -------
+    shards : list of tuple
+        (filename, start, stop) of every shard.
+    """
+    shards = []
+    for filename in inputs:
+        n_events = np.load(filename, mmap_mode="r").shape[0]
+        step = n_events if shard_size is None else shard_size
+        for start in range(0, n_events, max(step, 1)):
+            shards.append((filename, start, min(start + step, n_events)))
+    return shards
+
+
+def parallel_evaluate(
+    model_filename,
+    inputs,
+    output_dir,
+    n_processes=None,
+    threads_per_process=1,
+    chunk_size=100000,
+    shard_size=None,
+    cache=None,
+):
+    """
+    Evaluates a saved model on many events with a pool of worker processes. The inputs (.npy files) are split into
+    shards of rows, every worker loads the model once, evaluates its shards with `threads_per_process` intra-op
+    threads and writes one r_hat and one s_hat file per shard into `output_dir`. A `manifest.json` lists the shards
+    in input order.
+    Parameters
+    ----------
+    model_filename : str
+        Path of the saved model, as passed to `RatioEstimator.load()`.
+    inputs : list of str
+        Input files with observables of shape `(n_events, n_observables)`, read as memory maps.
+    output_dir : str
+        Folder for the sharded output and the manifest.
+    n_processes : int or None, optional
+        Number of worker processes. If None, the available CPUs divided by `threads_per_process`. Default value:
+        None.
+    threads_per_process : int, optional
+        Intra-op threads of every worker. Default value: 1.
+    chunk_size : int, optional
+        Events evaluated at once within a shard. Default value: 100000.
+    shard_size : int or None, optional
+        Maximal number of events per shard. If None, the total number of events divided by the number of processes,
+        so that even a single input file is spread over all workers. Default value: None.
+    cache : EvaluationCache or None, optional
+        If given, the shards of input files with cached results are written from the cache without starting
+        workers for them, and the results of the other files are added to the cache. Results of ensembles are only
+        read from the cache, since the shards do not hold the spread over the members. Default value: None.
+    Returns
+    -------
+    manifest : dict
+        The content of `manifest.json`.
+    """
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if n_processes is None:
+        n_processes = max(1, available_cpus() // threads_per_process)
+    create_missing_folders([output_dir])
+
+    time_started = time.time()
+    results = []
+    cached, cache_keys, estimator = {}, {}, None
+    if cache is not None:
+        from .ratio import RatioEstimator
+
+        estimator = RatioEstimator()
+        estimator.load(model_filename)
+        for filename in inputs:
+            cache_keys[filename] = cache.key(estimator.model_checksum(), data_fingerprint(filename), "torch")
+            outputs = cache.get(cache_keys[filename])
+            if outputs is not None:
+                cached[filename] = outputs
+
+    if shard_size is None:
+        n_events = sum(np.load(filename, mmap_mode="r").shape[0] for filename in inputs)
+        shard_size = max(1, -(-n_events // n_processes))
+    shards = make_shards(inputs, shard_size)
+    tasks = []
+    for shard_id, (filename, start, stop) in enumerate(shards):
+        if filename in cached:
+            r_hat, s_hat, _ = cached[filename]
+            results.append(
+                _save_shard(shard_id, filename, start, stop, output_dir, r_hat[start:stop], s_hat[start:stop], 0.0)
+            )
+        else:
+            tasks.append((shard_id, filename, start, stop, output_dir, chunk_size))
+    logger.info(
+        "Evaluating %s shards with %s processes of %s threads each, %s shards found in cache",
+        len(tasks),
+        n_processes,
+        threads_per_process,
+        len(results),
+    )
+
+    if tasks:
+        # Forking after pyTorch has started its thread pools is not safe
+        context = multiprocessing.get_context("spawn")
+        pool = context.Pool(n_processes, initializer=_init_worker, initargs=(model_filename, threads_per_process))
+        try:
+            for result in pool.imap_unordered(_evaluate_shard, tasks):
+                logger.debug("  Shard %s: %s events in %.1f s", result["shard"], result["n_events"], result["seconds"])
+                results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+    seconds = time.time() - time_started
+    results = sorted(results, key=lambda result: result["shard"])
+
+    if estimator is not None and estimator.n_ensemble == 1:
+        for filename in inputs:
+            if filename in cached:
+                continue
+            shards = [result for result in results if result["input"] == filename]
+            outputs = [
+                np.concatenate([np.load(os.path.join(output_dir, shard[key])) for shard in shards])
+                for key in ["r_hat", "s_hat"]
+            ]
+            cache.put(cache_keys[filename], outputs[0], outputs[1], np.zeros_like(outputs[0]))
+
+    n_events = sum(result["n_events"] for result in results)
+    manifest = {
+        "model": model_filename,
+        "inputs": list(inputs),
+        "n_events": n_events,
+        "n_processes": n_processes,
+        "threads_per_process": threads_per_process,
+        "seconds": seconds,
+        "shards": results,
+    }
+    with open(os.path.join(output_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    logger.info("Evaluated %s events in %.1f s (%.0f events / s)", n_events, seconds, n_events / max(seconds, 1.0e-9))
+    return manifest
+
+
+def load_sharded_output(output_dir, key="r_hat"):
+    """ Concatenates the sharded `r_hat` or `s_hat` output of `parallel_evaluate()` per input file """
+    with open(os.path.join(output_dir, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+
+    outputs = {}
+    for shard in manifest["shards"]:
+        outputs.setdefault(shard["input"], []).append(np.load(os.path.join(output_dir, shard[key])))
+    return {filename: np.concatenate(arrays) for filename, arrays in outputs.items()}
+
+
+def _branches_for_observables(observables, branches):
+    """ TTree branches needed for the flattened observables """
+    needed = []
+    for observable in observables:
+        if observable in branches:
+            branch = observable
+        else:
+            candidates = [name for name in branches if observable.startswith(name) and observable[len(name):].isdigit()]
+            if not candidates:
+                raise RuntimeError("Observable {} not found in the TTree".format(observable))
+            branch = max(candidates, key=len)
+        if branch not in needed:
+            needed.append(branch)
+    return needed
+
+
+def apply_to_root(
+    model,
+    input_file,
+    output_file,
+    tree_name="Tree",
+    features=None,
+    step_size=100000,
+    chunk_size=100000,
+    backend="torch",
+    write_s_hat=False,
+    entry_stop=None,
+):
+    """
+    Applies a model to a ROOT TTree chunk by chunk and writes the weights w_carl = 1 / r_hat into a new ROOT file with
+    a tree of the same name and the same entries, to be used as friend tree of the input. Memory stays constant and no
+    intermediate .npy files are written. The evaluation cache is not used: its entries are whole .npy files or arrays,
+    and caching every chunk of a tree would cost a checksum and a copy of each chunk for little reuse.
+    Parameters
+    ----------
+    model : RatioEstimator or str
+        Model, or the path of a saved model.
+    input_file : str
+        Input ROOT file.
+    output_file : str
+        Output ROOT file.
+    tree_name : str, optional
+        Name of the TTree in the input and the output file. Default value: "Tree".
+    features : list of str or None, optional
+        Branches used in the training, only needed for models saved without the names of the observables. These
+        have to be scalar branches. Default value: None.
+    step_size : int, optional
+        Number of entries read from the input at once. Default value: 100000.
+    chunk_size : int, optional
+        Number of events evaluated at once. Default value: 100000.
+    backend : {"torch", "onnxruntime"}, optional
+        Inference backend, see `RatioEstimator.evaluate_ratio()`. Default value: "torch".
+    write_s_hat : bool, optional
+        If True, the classifier output s_hat is written as well. Default value: False.
+    entry_stop : int or None, optional
+        Only the entries before entry_stop are processed. If None, all entries. Default value: None.
+    Returns
+    -------
+    n_events : int
+        Number of processed events.
+    """
+    import uproot
+    from .ratio import RatioEstimator
+
+    if not isinstance(model, RatioEstimator):
+        filename = model
+        model = RatioEstimator()
+        model.load(filename)
+
+    observables = model.observables
+    if observables is None:
+        if not features:
+            raise RuntimeError("Model was saved without the names of its observables, please pass the features")
+        logger.warning("Model was saved without the names of its observables, using the sorted features")
+        observables = sorted(features)
+
+    tree = uproot.open(input_file)[tree_name]
+    branches = _branches_for_observables(observables, tree.keys())
+    logger.info("Applying model to %s with %s observables from %s branches", input_file, len(observables), len(branches))
+
+    create_missing_folders([os.path.dirname(output_file)])
+    output_branches = {"w_carl": np.float32}
+    if write_s_hat:
+        output_branches["s_hat"] = np.float32
+
+    n_events = 0
+    time_started = time.time()
+    with uproot.recreate(output_file) as output:
+        output.mktree(tree_name, output_branches)
+        for arrays in tree.iterate(branches, step_size=step_size, library="np", entry_stop=entry_stop):
+            x = flatten_arrays(arrays, observables)
+            r_hat, s_hat = model.evaluate_ratio(x, chunk_size=chunk_size, backend=backend, cache=False)
+            chunk = {"w_carl": (1.0 / r_hat).astype(np.float32)}
+            if write_s_hat:
+                chunk["s_hat"] = s_hat.astype(np.float32)
+            output[tree_name].extend(chunk)
+            n_events += len(x)
+            logger.debug("  %s events done", n_events)
+
+    seconds = time.time() - time_started
+    logger.info("Wrote weights of %s events to %s in %.1f s", n_events, output_file, seconds)
+    return n_events
+
+
+def batch_evaluate(models, samples, output_dir, chunk_size=100000, backend="torch", write_s_hat=False, cache=None):
+    """
+    Evaluates several models on several samples in one pass: every sample is memory mapped and read once, chunk by
+    chunk, and each chunk is evaluated by all models. The weights 1 / r_hat are written into one memory-mapped
+    array per sample, `<sample>_weights.npy` of shape `(n_events, n_models)` with one column per model, described by
+    `weights.json`.
+    Parameters
+    ----------
+    models : dict
+        Names and models (RatioEstimator instances or paths of saved models), in column order.
+    samples : dict or list of str
+        Names and paths of .npy files with the observables. For a list, the file names are the sample names.
+    output_dir : str
+        Output folder.
+    chunk_size : int, optional
+        Number of events read and evaluated at once. Default value: 100000.
+    backend : {"torch", "onnxruntime"}, optional
+        Inference backend, see `RatioEstimator.evaluate_ratio()`. Default value: "torch".
+    write_s_hat : bool, optional
+        If True, the classifier outputs are written to `<sample>_s_hat.npy` as well. Default value: False.
+    cache : EvaluationCache or None, optional
+        If given, models with cached results for a whole sample are not evaluated again. Results of the chunked
+        evaluation are not added to the cache. Default value: None.
+    Returns
+    -------
+    description : dict
+        The content of `weights.json`.
+    """
+    from .ratio import RatioEstimator
+
+    if not isinstance(samples, dict):
+        samples = {os.path.splitext(os.path.basename(filename))[0]: filename for filename in samples}
+    estimators = []
+    for name, model in models.items():
+        if not isinstance(model, RatioEstimator):
+            filename = model
+            model = RatioEstimator()
+            model.load(filename)
+        estimators.append(model)
+    create_missing_folders([output_dir])
+
+    description = {"columns": list(models.keys()), "samples": {}}
+    for sample, filename in samples.items():
+        x = np.load(filename, mmap_mode="r")
+        n_events = x.shape[0]
+        logger.info("Evaluating %s models on %s events of %s", len(estimators), n_events, sample)
+
+        weights_file = sample + "_weights.npy"
+        weights = np.lib.format.open_memmap(
+            os.path.join(output_dir, weights_file), mode="w+", dtype=np.float32, shape=(n_events, len(estimators))
+        )
+        if write_s_hat:
+            s_hat_file = sample + "_s_hat.npy"
+            s_hats = np.lib.format.open_memmap(
+                os.path.join(output_dir, s_hat_file), mode="w+", dtype=np.float32, shape=(n_events, len(estimators))
+            )
+
+        time_started = time.time()
+        columns = list(range(len(estimators)))
+        if cache is not None:
+            for column, estimator in enumerate(estimators):
+                cached = cache.get(cache.key(estimator.model_checksum(), data_fingerprint(filename), backend))
+                if cached is not None:
+                    weights[:, column] = 1.0 / cached[0]
+                    if write_s_hat:
+                        s_hats[:, column] = cached[1]
+                    columns.remove(column)
+
+        for start in range(0, n_events if columns else 0, chunk_size):
+            stop = min(start + chunk_size, n_events)
+            # Read and convert once for all models
+            x_chunk = np.asarray(x[start:stop], dtype=np.float32)
+            for column in columns:
+                estimator = estimators[column]
+                r_hat, s_hat = estimator.evaluate_ratio(x_chunk, chunk_size=chunk_size, backend=backend, cache=False)
+                weights[start:stop, column] = 1.0 / r_hat
+                if write_s_hat:
+                    s_hats[start:stop, column] = s_hat
+        weights.flush()
+        if write_s_hat:
+            s_hats.flush()
+
+        description["samples"][sample] = {
+            "input": filename,
+            "n_events": n_events,
+            "weights": weights_file,
+            "s_hat": s_hat_file if write_s_hat else None,
+            "seconds": time.time() - time_started,
+        }
+        del weights
+
+    with open(os.path.join(output_dir, "weights.json"), "w") as f:
+        json.dump(description, f, indent=2)
+    return description
@@ -1,5 +1,6 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import math
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
@@ -10,6 +11,27 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+class InputScaling(nn.Module):
+    """
+    Frozen input normalisation (x - shift) * scale, stored as buffers so that it is part of the state dict and of
+    the exported onnx graph but never trained.
+    """
+
+    def __init__(self, n_observables):
+
+        super(InputScaling, self).__init__()
+
+        self.register_buffer("shift", torch.zeros(n_observables))
+        self.register_buffer("scale", torch.ones(n_observables))
+
+    def set_scaling(self, shift, scale):
+        self.shift.copy_(torch.as_tensor(shift, dtype=self.shift.dtype))
+        self.scale.copy_(torch.as_tensor(scale, dtype=self.scale.dtype))
+
+    def forward(self, x: torch.Tensor):
+        return (x - self.shift) * self.scale
+
+
 class RatioModel(nn.Module):
 
     def __init__(self, n_observables, n_hidden, activation="relu", dropout_prob=0.5):
@@ -22,6 +44,7 @@ class RatioModel(nn.Module):
         self.dropout_prob = dropout_prob
 
         # Build network
+        self.input_scaling = InputScaling(n_observables)
         self.layers = nn.ModuleList()
         n_last = n_observables
 
@@ -37,15 +60,21 @@ class RatioModel(nn.Module):
             self.layers.append(nn.Dropout(self.dropout_prob))
         self.layers.append(nn.Linear(n_last, 1))
 
-    def forward(self, x: torch.Tensor):
-        s_hat = x
+    def logits(self, x: torch.Tensor):
+        logit = self.input_scaling(x)
         for i, layer in enumerate(self.layers):
             if i > 0:
-                s_hat = self.activation(s_hat)
-            s_hat = layer(s_hat) 
-        s_hat = torch.sigmoid(s_hat)
-        r_hat = (1 - s_hat) / s_hat
-        
+                logit = self.activation(logit)
+            logit = layer(logit)
+
+        return logit
+
+    def forward(self, x: torch.Tensor):
+        # r_hat = (1 - s_hat) / s_hat = exp(-logit)
+        logit = self.logits(x)
+        s_hat = torch.sigmoid(logit)
+        r_hat = torch.exp(-logit)
+
         return r_hat, s_hat
 
     def to(self, *args, **kwargs):
@@ -56,3 +85,85 @@ class RatioModel(nn.Module):
 
         return self
 
+
+
+class EnsembleLinear(nn.Module):
+    """ Linear layer holding the weights of several independent ensemble members, evaluated with one batched matmul """
+
+    def __init__(self, n_members, in_features, out_features):
+
+        super(EnsembleLinear, self).__init__()
+
+        self.n_members = n_members
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(torch.empty(n_members, in_features, out_features))
+        self.bias = nn.Parameter(torch.empty(n_members, 1, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Same distribution as the default nn.Linear initialisation, drawn independently for every member
+        bound = 1.0 / math.sqrt(self.in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x: torch.Tensor):
+        # x has shape (n_members, n_batch, in_features)
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+class EnsembleRatioModel(nn.Module):
+    """ Deep ensemble of `n_members` RatioModel networks trained together on shared mini-batches """
+
+    def __init__(self, n_members, n_observables, n_hidden, activation="relu", dropout_prob=0.5):
+
+        super(EnsembleRatioModel, self).__init__()
+
+        # Save input
+        self.n_members = n_members
+        self.n_hidden = n_hidden
+        self.activation = get_activation(activation)
+        self.dropout_prob = dropout_prob
+
+        # Build network
+        self.input_scaling = InputScaling(n_observables)
+        self.layers = nn.ModuleList()
+        n_last = n_observables
+
+        # Hidden layers
+        for n_hidden_units in n_hidden:
+            if self.dropout_prob > 1.0e-9:
+                self.layers.append(nn.Dropout(self.dropout_prob))
+            self.layers.append(EnsembleLinear(n_members, n_last, n_hidden_units))
+            n_last = n_hidden_units
+
+        # Log r layer
+        if self.dropout_prob > 1.0e-9:
+            self.layers.append(nn.Dropout(self.dropout_prob))
+        self.layers.append(EnsembleLinear(n_members, n_last, 1))
+
+    def logits(self, x: torch.Tensor):
+        # Every member sees the same batch
+        logit = self.input_scaling(x)
+        logit = logit.unsqueeze(0).expand(self.n_members, -1, -1)
+        for i, layer in enumerate(self.layers):
+            if i > 0:
+                logit = self.activation(logit)
+            logit = layer(logit)
+
+        return logit
+
+    def forward(self, x: torch.Tensor):
+        logit = self.logits(x)
+        s_hat = torch.sigmoid(logit)
+        r_hat = torch.exp(-logit)
+
+        return r_hat, s_hat
+
+    def to(self, *args, **kwargs):
+        self = super(EnsembleRatioModel, self).to(*args, **kwargs)
+
+        for i, layer in enumerate(self.layers):
+            self.layers[i] = layer.to(*args, **kwargs)
+
+        return self
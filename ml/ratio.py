@@ -1,14 +1,18 @@
 from __future__ import absolute_import, division, print_function
 
+import time
 import logging
 import numpy as np
 import torch
+from torch import nn
 from collections import OrderedDict
+from sklearn.metrics import roc_auc_score
 
-from .evaluate import evaluate_ratio_model, evaluate_performance_model
-from .models import RatioModel
+from .evaluate import evaluate_ratio_model, evaluate_ratio_onnx, evaluate_performance_model
+from .models import RatioModel, EnsembleRatioModel, EnsembleLinear
 from .functions import get_optimizer, get_loss
 from .utils.tools import load_and_check
+from .utils.cache import EvaluationCache, data_fingerprint
 from .trainers import RatioTrainer
 from .base import Estimator
 
@@ -34,6 +38,9 @@ class RatioEstimator(Estimator):
         Default value: (100,).
     activation : {'tanh', 'sigmoid', 'relu'}, optional
         Activation function. Default value: 'tanh'.
+    n_ensemble : int, optional
+        Number of independently initialised networks trained together as a deep ensemble, sharing every
+        mini-batch. Evaluation then averages over the members. Default value: 1.
     """
 
     def train(
@@ -57,6 +64,7 @@ class RatioEstimator(Estimator):
         validation_split=0.25,
         early_stopping=True,
         scale_inputs=True,
+        scaling="minmax",
         limit_samplesize=None,
         memmap=False,
         verbose="some",
@@ -64,6 +72,22 @@ class RatioEstimator(Estimator):
         n_workers=8,
         clip_gradient=None,
         early_stopping_patience=None,
+        micro_batch_size=None,
+        memory_budget_gb=None,
+        prefetch=False,
+        validate_every=1,
+        n_validation_samples=None,
+        n_threads=None,
+        autotune=False,
+        autotune_profile=None,
+        autotune_batch_sizes=None,
+        balance_ratio=None,
+        balance_importance=False,
+        progressive_fractions=None,
+        progressive_epochs=None,
+        progressive_patience=2,
+        init_from=None,
+        freeze_layers=0,
     ):
 
         """
@@ -100,10 +124,64 @@ class RatioEstimator(Estimator):
             True.
         scale_inputs : bool, optional
             Scale the observables to zero mean and unit variance. Default value: True.
+        scaling : {"minmax", "standard"}, optional
+            Input scaling, applied by a frozen first layer of the network, so that the same scaling is used in
+            training, evaluation and the exported onnx model. Default value: "minmax".
         memmap : bool, optional.
             If True, training files larger than 1 GB will not be loaded into memory at once. Default value: False.
         verbose : {"all", "many", "some", "few", "none}, optional
             Determines verbosity of training. Default value: "some".
+        micro_batch_size : int or "auto" or None, optional
+            If smaller than batch_size, every batch is processed as several micro-batches of this size and the
+            gradients are accumulated before a single optimizer step, which keeps the effective batch size at
+            batch_size with a smaller memory peak. "auto" picks the largest size fitting into memory_budget_gb.
+            Default value: None.
+        memory_budget_gb : float or None, optional
+            Memory budget for one forward / backward pass, used with micro_batch_size="auto". Default value: None.
+        prefetch : bool, optional
+            If True, the next batches are converted, staged in pinned memory and copied to the device on a
+            background thread while the current batch is trained on. Default value: False.
+        validate_every : int, optional
+            Run the validation pass only every validate_every epochs (and after the last one). Early stopping is
+            evaluated on these epochs only, its patience is still counted in epochs. Default value: 1.
+        n_validation_samples : int or None, optional
+            If given, validation runs on a fixed random subsample of this many validation events. Default value:
+            None.
+        n_workers : int, optional
+            Number of DataLoader worker processes. Default value: 8.
+        n_threads : int or None, optional
+            Number of intra-op threads used by pyTorch. If None, the pyTorch default is kept. Default value: None.
+        autotune : bool, optional
+            If True, a short benchmark on a sample of the training data picks the number of DataLoader workers,
+            intra-op threads and (if autotune_batch_sizes is given) the batch size with the highest throughput, within
+            the CPU affinity mask of the job. Default value: False.
+        autotune_profile : str or None, optional
+            JSON file with the autotuned configuration. If it exists, it is reused without benchmarking, otherwise the
+            chosen configuration is written to it. Default value: None.
+        autotune_batch_sizes : list of int or None, optional
+            Batch sizes tried by the autotuner. If None, only batch_size is used. Default value: None.
+        balance_ratio : float or None, optional
+            If given, every epoch trains on all events of the smaller class (usually the variation) plus a fresh
+            random subset of balance_ratio times as many events of the larger class (usually the nominal). The weights
+            of the subsampled events are compensated, so the loss is not biased. Default value: None.
+        balance_importance : bool, optional
+            If True, the larger class is importance sampled with probabilities proportional to |w|, instead of
+            uniformly. Default value: False.
+        progressive_fractions : tuple of float or None, optional
+            If given, e.g. (0.1, 0.3, 1.0), training starts on a random subset with the first fraction of the training
+            events and grows through nested subsets to the last fraction. The learning rate decay is unchanged, and
+            early stopping only ends the training in the last stage. Default value: None.
+        progressive_epochs : tuple of int or None, optional
+            First epoch of every progressive stage, e.g. (0, 10, 30). If None, the next stage starts once the
+            validation loss has not improved for progressive_patience epochs. Default value: None.
+        progressive_patience : int, optional
+            Plateau patience (in epochs) of the progressive stages. Default value: 2.
+        init_from : str or None, optional
+            Path (as passed to `save()`) of a trained model, e.g. of a neighbouring variation. Its weights and input
+            scaling are used as starting point and fine-tuned, which usually needs far fewer epochs than a training
+            from scratch. The features, observables and architecture have to match. Default value: None.
+        freeze_layers : int, optional
+            Number of leading linear layers that are kept fixed during the fine-tuning. Default value: 0.
         Returns
         -------
             None
@@ -112,6 +190,8 @@ class RatioEstimator(Estimator):
         logger.info("Starting training")
         logger.info("  Method:                 %s", method)
         logger.info("  Batch size:             %s", batch_size)
+        if micro_batch_size is not None:
+            logger.info("  Micro-batch size:       %s", micro_batch_size)
         logger.info("  Optimizer:              %s", optimizer)
         logger.info("  Epochs:                 %s", n_epochs)
         logger.info("  Learning rate:          %s initially, decaying to %s", initial_lr, final_lr)
@@ -120,6 +200,13 @@ class RatioEstimator(Estimator):
         logger.info("  Validation split:       %s", validation_split)
         logger.info("  Early stopping:         %s", early_stopping)
         logger.info("  Scale inputs:           %s", scale_inputs)
+        if scale_inputs:
+            logger.info("  Scaling:                %s", scaling)
+        if self.n_ensemble > 1:
+            logger.info("  Ensemble members:       %s", self.n_ensemble)
+        if init_from is not None:
+            logger.info("  Initialised from:       %s", init_from)
+            logger.info("  Frozen layers:          %s", freeze_layers)
         if limit_samplesize is None:
             logger.info("  Samples:                all")
         else:
@@ -149,12 +236,15 @@ class RatioEstimator(Estimator):
             assert x_val.shape[1] == n_observables
 
 
-        # Scale features
+        # Warm start, including the input scaling of the initial model
+        if init_from is not None:
+            self._initialize_from(init_from, n_observables)
+
+        # Scale features (applied inside the network, see _set_model_input_scaling)
         if scale_inputs:
+            if init_from is None:
+                self.scaling = scaling
             self.initialize_input_transform(x, overwrite=False)
-            x = self._transform_inputs(x)
-            if external_validation:
-                x_val = self._transform_inputs(x_val)
         else:
             self.initialize_input_transform(x, False, overwrite=False)
 
@@ -186,6 +276,10 @@ class RatioEstimator(Estimator):
         if self.model is None:
             logger.info("Creating model")
             self._create_model()
+        if self.quantized:
+            logger.info("Training the float model, the int8 quantization is dropped")
+            self._dequantize_model()
+        self._set_model_input_scaling()
         # Losses
         if w is None:
             w = len(x0)/len(x1) 
@@ -195,67 +289,342 @@ class RatioEstimator(Estimator):
         # Optimizer
         opt, opt_kwargs = get_optimizer(optimizer, nesterov_momentum)
 
-        # Train model
-        logger.info("Training model")
-        trainer = RatioTrainer(self.model, n_workers=n_workers)
-        result = trainer.train(
-            data=data,
-            data_val=data_val,
-            loss_functions=loss_functions,
-            loss_weights=loss_weights, #sjiggins
-            #loss_weights=w, #sjiggins
-            loss_labels=loss_labels,
-            epochs=n_epochs,
-            batch_size=batch_size,
-            optimizer=opt,
-            optimizer_kwargs=opt_kwargs,
-            initial_lr=initial_lr,
-            final_lr=final_lr,
-            validation_split=validation_split,
-            early_stopping=early_stopping,
-            verbose=verbose,
-            clip_gradient=clip_gradient,
-            early_stopping_patience=early_stopping_patience,
-        )
+        # Freeze leading layers for fine-tuning, they are released again even if the training fails
+        if freeze_layers > 0:
+            self._freeze_layers(freeze_layers)
+
+        try:
+            # Train model
+            logger.info("Training model")
+            trainer = RatioTrainer(self.model, n_workers=n_workers, n_threads=n_threads)
+            result = trainer.train(
+                data=data,
+                data_val=data_val,
+                loss_functions=loss_functions,
+                loss_weights=loss_weights, #sjiggins
+                #loss_weights=w, #sjiggins
+                loss_labels=loss_labels,
+                epochs=n_epochs,
+                batch_size=batch_size,
+                optimizer=opt,
+                optimizer_kwargs=opt_kwargs,
+                initial_lr=initial_lr,
+                final_lr=final_lr,
+                validation_split=validation_split,
+                early_stopping=early_stopping,
+                verbose=verbose,
+                clip_gradient=clip_gradient,
+                early_stopping_patience=early_stopping_patience,
+                micro_batch_size=micro_batch_size,
+                memory_budget_gb=memory_budget_gb,
+                prefetch=prefetch,
+                validate_every=validate_every,
+                n_validation_samples=n_validation_samples,
+                autotune=autotune,
+                autotune_profile=autotune_profile,
+                autotune_batch_sizes=autotune_batch_sizes,
+                balance_ratio=balance_ratio,
+                balance_importance=balance_importance,
+                progressive_fractions=progressive_fractions,
+                progressive_epochs=progressive_epochs,
+                progressive_patience=progressive_patience,
+            )
+        finally:
+            if freeze_layers > 0:
+                self._freeze_layers(0)
+            # The weights may have changed even if the training failed
+            self._ort_session = None
+            self.calibration = None
         return result
 
-    def evaluate_ratio(self, x):
+    def evaluate_ratio(
+        self,
+        x,
+        return_std=False,
+        chunk_size=100000,
+        memmap=False,
+        backend="torch",
+        n_threads=None,
+        check_parity=True,
+        cache=None,
+    ):
         """
         Evaluates the ratio as a function of the observation x.
         Parameters
         ----------
         x : str or ndarray
             Observations or filename of a pickled numpy array.
+        return_std : bool, optional
+            If True, also returns the spread of the ratio over the ensemble members (zero for a single
+            network). Default value: False.
+        chunk_size : int, optional
+            Number of events evaluated at once. Default value: 100000.
+        memmap : bool, optional
+            If True, files larger than 1 GB are memory mapped instead of being loaded into memory. Default value:
+            False.
+        backend : {"torch", "onnxruntime"}, optional
+            Inference backend. "onnxruntime" evaluates the exported model in a cached onnxruntime session on the CPU,
+            like the deployment in Athena. Default value: "torch".
+        n_threads : int or None, optional
+            Intra-op threads of the onnxruntime session. If None, the number of available CPUs. Default value: None.
+        check_parity : bool, optional
+            If True, the first evaluation of a new onnxruntime session is compared to pyTorch on up to 1000 events
+            and a RuntimeError is raised if they disagree. Default value: True.
+        cache : EvaluationCache or bool or None, optional
+            Persistent cache of the results, keyed by the model checksum, the data (path and modification time of a
+            file, or checksum of an array) and the backend. True uses the default cache folder. If None,
+            `self.evaluation_cache` is used. Default value: None.
         Returns
         -------
         ratio : ndarray
-            The estimated ratio. It has shape `(n_samples,)`.
+            The estimated ratio (mean over the ensemble members). It has shape `(n_samples,)`.
+        s_hat : ndarray
+            The classifier output (mean over the ensemble members). It has shape `(n_samples,)`.
+        ratio_std : ndarray
+            Standard deviation of the ratio over the ensemble members. Only returned if `return_std` is True.
         """
         if self.model is None:
             raise ValueError("No model -- train or load model before evaluating it!")
 
-        # Load training data
+        # Cached results
+        if cache is None:
+            cache = self.evaluation_cache
+        if cache is True:
+            cache = EvaluationCache()
+        if cache:
+            cache_key = cache.key(self.model_checksum(), data_fingerprint(x), backend)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                r_hat, s_hat, r_hat_std = cached
+                if return_std:
+                    return r_hat, s_hat, r_hat_std
+                return r_hat, s_hat
+
+        # Load evaluation data. The full scans for NaNs and large values would cost a temporary of the size of the
+        # input, so only the outputs are checked below
         logger.debug("Loading evaluation data")
-        x = load_and_check(x)
+        x = load_and_check(x, memmap_files_larger_than_gb=1.0 if memmap else None, check=False)
 
-        # Scale observables
-        x = self._transform_inputs(x)
-
-        # Restrict features
-        if self.features is not None:
-            x = x[:, self.features]
+        # The input scaling is part of the model, features are selected chunk by chunk
         logger.debug("Starting ratio evaluation")
-        r_hat, s_hat = evaluate_ratio_model(
-            model=self.model,
-            xs=x,
-        )
+        if backend == "onnxruntime":
+            # A new session is also created when the number of threads changes
+            previous_session = self._ort_session
+            session = self.onnx_session(n_threads=n_threads)
+            r_hat, s_hat = evaluate_ratio_onnx(session, xs=x, chunk_size=chunk_size, features=self.features)
+            if check_parity and session is not previous_session:
+                self._check_onnx_parity(x[:1000], s_hat[..., :1000])
+        elif backend == "torch":
+            r_hat, s_hat = evaluate_ratio_model(
+                model=self.model,
+                xs=x,
+                run_on_gpu=not self.quantized,
+                chunk_size=chunk_size,
+                features=self.features,
+            )
+        else:
+            raise ValueError("Unknown inference backend {}".format(backend))
         logger.debug("Evaluation done")
+        n_invalid = np.sum(~np.isfinite(s_hat))
+        if n_invalid > 0:
+            logger.warning("%s classifier outputs are not finite, the input may contain NaNs or Infs", n_invalid)
+        if r_hat.ndim == 2:
+            r_hat_std = np.std(r_hat, axis=0)
+            r_hat = np.mean(r_hat, axis=0)
+            s_hat = np.mean(s_hat, axis=0)
+        else:
+            r_hat_std = np.zeros_like(r_hat)
+        if cache:
+            cache.put(cache_key, r_hat, s_hat, r_hat_std)
+        if return_std:
+            return r_hat, s_hat, r_hat_std
         return r_hat, s_hat 
 
     def evaluate(self, *args, **kwargs):
         return self.evaluate_ratio(*args, **kwargs)
 
-    def evaluate_performance(self, x, y):
+    def distill(
+        self,
+        teacher,
+        x,
+        y=None,
+        w=None,
+        x_unlabeled=None,
+        w_unlabeled=None,
+        x_test=None,
+        y_test=None,
+        w_test=None,
+        chunk_size=100000,
+        **kwargs
+    ):
+        """
+        Knowledge distillation: trains this (usually much smaller) estimator to reproduce a teacher model. The
+        targets are the teacher's s_hat = sigmoid(logit) on the training sample and on additional unlabeled nominal
+        events, and the cross-entropy with these soft targets is minimal when the student's logits match the
+        teacher's. The student is a normal single network, saved with `save()`.
+        Parameters
+        ----------
+        teacher : RatioEstimator or str
+            Trained teacher, for instance a wide network or an ensemble, or the path of a saved model.
+        x : ndarray or str
+            Training observations.
+        y : ndarray or str or None, optional
+            True class labels of x, only used for the report if no test sample is given. Default value: None.
+        w : ndarray or str or None, optional
+            Event weights of x. Default value: None.
+        x_unlabeled : ndarray or str or None, optional
+            Additional nominal observations without labels. Default value: None.
+        w_unlabeled : ndarray or str or None, optional
+            Event weights of x_unlabeled. If None, every unlabeled event has weight 1. Default value: None.
+        x_test, y_test, w_test : ndarray or str or None, optional
+            Labelled sample for the report. Default value: None.
+        chunk_size : int, optional
+            Number of events evaluated at once. Default value: 100000.
+        kwargs
+            Passed on to `train()`, for instance n_epochs or batch_size.
+        Returns
+        -------
+        report : dict or None
+            AUC, closure (relative difference between the sum of the reweighted nominal and the variation weights)
+            and evaluation time per event for teacher and student, if a labelled sample is available.
+        """
+        if self.n_ensemble > 1:
+            raise RuntimeError("The student of a distillation has to be a single network")
+        if not isinstance(teacher, RatioEstimator):
+            filename = teacher
+            teacher = RatioEstimator()
+            teacher.load(filename)
+
+        x = load_and_check(x)
+        # Labels given as file names are loaded before their length is used to select the labelled events
+        y = None if y is None else load_and_check(y).reshape(-1)
+        x_unlabeled = load_and_check(x_unlabeled)
+        w = np.ones(len(x)) if w is None else load_and_check(w).reshape(-1)
+        if x_unlabeled is not None:
+            w_unlabeled = np.ones(len(x_unlabeled)) if w_unlabeled is None else load_and_check(w_unlabeled).reshape(-1)
+            logger.info("Adding %s unlabeled events to the %s training events", len(x_unlabeled), len(x))
+            x = np.concatenate((x, x_unlabeled), axis=0)
+            w = np.concatenate((w, w_unlabeled))
+
+        # Soft targets from the teacher
+        logger.info("Evaluating teacher on %s events", len(x))
+        _, s_teacher = teacher.evaluate_ratio(x, chunk_size=chunk_size)
+        self.train(method="carl", x=x, y=s_teacher.astype(x.dtype), w=w, **kwargs)
+
+        # Report
+        if x_test is None and y is not None:
+            x_test, y_test, w_test = x[: len(y)], y, w[: len(y)]
+        if x_test is None or y_test is None:
+            return None
+        x_test = load_and_check(x_test)
+        y_test = load_and_check(y_test).reshape(-1)
+        w_test = np.ones(len(x_test)) if w_test is None else load_and_check(w_test).reshape(-1)
+
+        report = {}
+        for label, estimator in [("teacher", teacher), ("student", self)]:
+            time_started = time.time()
+            r_hat, s_hat = estimator.evaluate_ratio(x_test, chunk_size=chunk_size)
+            seconds = time.time() - time_started
+            nominal = y_test == 0
+            reweighted = np.sum(w_test[nominal] / r_hat[nominal])
+            report[label] = {
+                "auc": float(roc_auc_score(y_test, s_hat, sample_weight=w_test)),
+                "closure": float(reweighted / np.sum(w_test[~nominal]) - 1.0),
+                "seconds_per_event": seconds / max(len(x_test), 1),
+            }
+            logger.info(
+                "  %s: AUC %.4f, closure %.2e, %.2e s per event",
+                label.capitalize(),
+                report[label]["auc"],
+                report[label]["closure"],
+                report[label]["seconds_per_event"],
+            )
+        return report
+
+    def quantize(self, x=None, tolerance=0.01, force=False, chunk_size=100000):
+        """
+        Post-training dynamic int8 quantization of the linear layers for cheaper inference on CPUs. The weights
+        are stored as int8 and the activations are quantized on the fly. The float weights are kept: `save()` stores
+        them together with the flag, `load()` quantizes them again, and `save(export_model=True)` writes an
+        additional '_int8.onnx' model quantized by onnxruntime.
+        Parameters
+        ----------
+        x : str or ndarray or None, optional
+            Validation observations used to compare the weights 1 / r_hat of the quantized and the float model. If
+            None, the model is quantized without a report. Default value: None.
+        tolerance : float, optional
+            Maximal relative shift of the sum and of the quantiles of the weights. Default value: 0.01.
+        force : bool, optional
+            If True, the quantized model is kept even if the weights shift by more than the tolerance.
+            Default value: False.
+        chunk_size : int, optional
+            Number of events evaluated at once. Default value: 100000.
+        Returns
+        -------
+        report : dict or None
+            Relative deviations of the weights, the relative shift of their sum and the largest relative shift of
+            the 1%, 5%, 25%, 50%, 75%, 95% and 99% quantiles, and whether these shifts are within the tolerance.
+        """
+        if self.model is None:
+            raise ValueError("No model -- train or load model before quantizing it!")
+        if self.n_ensemble > 1:
+            raise ValueError(
+                "Quantization is not supported for ensembles of {} networks -- distill the ensemble into a single "
+                "network first, see RatioEstimator.distill()".format(self.n_ensemble)
+            )
+        if self.quantized:
+            logger.info("Model is already quantized")
+            return None
+
+        if x is not None:
+            x = load_and_check(x)
+            r_float, _ = self.evaluate_ratio(x, chunk_size=chunk_size)
+
+        logger.info("Quantizing the linear layers to int8")
+        self._quantize_model()
+        if x is None:
+            return None
+
+        r_int8, _ = self.evaluate_ratio(x, chunk_size=chunk_size)
+        w_float, w_int8 = 1.0 / r_float, 1.0 / r_int8
+        relative_deviation = np.abs(w_int8 / w_float - 1.0)
+        quantiles = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+        quantile_shift = np.abs(np.quantile(w_int8, quantiles) / np.quantile(w_float, quantiles) - 1.0)
+        report = {
+            "mean_relative_deviation": float(np.mean(relative_deviation)),
+            "max_relative_deviation": float(np.max(relative_deviation)),
+            "sum_shift": float(abs(np.sum(w_int8) / np.sum(w_float) - 1.0)),
+            "quantile_shift": float(np.max(quantile_shift)),
+        }
+        report["within_tolerance"] = report["sum_shift"] <= tolerance and report["quantile_shift"] <= tolerance
+        logger.info(
+            "Quantized weights: mean relative deviation %.2e, max %.2e, shift of the sum %.2e, of the quantiles %.2e",
+            report["mean_relative_deviation"],
+            report["max_relative_deviation"],
+            report["sum_shift"],
+            report["quantile_shift"],
+        )
+
+        if not report["within_tolerance"] and not force:
+            logger.warning("Weights shift by more than the tolerance %s, keeping the float model", tolerance)
+            self._dequantize_model()
+        return report
+
+    def _check_onnx_parity(self, x, s_hat_onnx, rtol=1.0e-4, atol=1.0e-5):
+        """ Compares the classifier output of the onnxruntime backend to pyTorch """
+        _, s_hat_torch = evaluate_ratio_model(
+            model=self.model, xs=x, run_on_gpu=not self.quantized, features=self.features
+        )
+        if self.quantized:
+            # onnxruntime and pyTorch quantize the activations differently
+            rtol, atol = 1.0e-2, 1.0e-2
+        deviation = np.max(np.abs(s_hat_onnx - s_hat_torch)) if len(x) > 0 else 0.0
+        if not np.allclose(s_hat_onnx, s_hat_torch, rtol=rtol, atol=atol):
+            self._ort_session = None
+            raise RuntimeError("onnxruntime and pyTorch outputs differ by up to {}".format(deviation))
+        logger.debug("onnxruntime matches pyTorch on %s events, maximal deviation %s", len(x), deviation)
+
+    def evaluate_performance(self, x, y, chunk_size=100000):
         """
         Evaluates the performance of the classifier.
         Parameters
@@ -273,20 +642,66 @@ class RatioEstimator(Estimator):
         x = load_and_check(x)
         y = load_and_check(y)
 
-        # Scale observables
-        x = self._transform_inputs(x)
-
-        # Restrict features
-        if self.features is not None:
-            x = x[:, self.features]
+        # The input scaling is part of the model, features are selected chunk by chunk
         evaluate_performance_model(
             model=self.model,
             xs=x,
             ys=y,
+            run_on_gpu=not self.quantized,
+            chunk_size=chunk_size,
+            features=self.features,
         )
         logger.debug("Evaluation done")
 
+    def _initialize_from(self, filename, n_observables):
+        """ Takes over weights and input scaling of a saved model after checking that it is compatible """
+        source = RatioEstimator()
+        source.load(filename)
+        source._dequantize_model()
+
+        n_observables_used = n_observables if self.features is None else len(self.features)
+        for label, ours, theirs in [
+            ("features", self.features, source.features),
+            ("observables", n_observables_used, source.n_observables),
+            ("hidden layers", tuple(self.n_hidden), tuple(source.n_hidden)),
+            ("activation", self.activation, source.activation),
+            ("ensemble members", self.n_ensemble, source.n_ensemble),
+        ]:
+            if ours != theirs:
+                raise RuntimeError(
+                    "Cannot initialise from {}, {} do not match: {} vs {}".format(filename, label, ours, theirs)
+                )
+        if self.n_observables is not None and self.n_observables != source.n_observables:
+            raise RuntimeError(
+                "Number of observables does not match model: {} vs {}".format(source.n_observables, self.n_observables)
+            )
+
+        self.n_observables = source.n_observables
+        self.dropout_prob = source.dropout_prob
+        self.scaling = source.scaling
+        self.x_scaling_means = source.x_scaling_means
+        self.x_scaling_stds = source.x_scaling_stds
+        self.x_scaling_mins = source.x_scaling_mins
+        self.x_scaling_maxs = source.x_scaling_maxs
+        self.model = source.model
+
+    def _freeze_layers(self, n_layers):
+        """ Freezes the first n_layers linear layers and unfreezes all others """
+        linear_layers = [layer for layer in self.model.layers if isinstance(layer, (nn.Linear, EnsembleLinear))]
+        for i, layer in enumerate(linear_layers):
+            for parameter in layer.parameters():
+                parameter.requires_grad = i >= n_layers
+
     def _create_model(self):
+        if self.n_ensemble > 1:
+            self.model = EnsembleRatioModel(
+                n_members=self.n_ensemble,
+                n_observables=self.n_observables,
+                n_hidden=self.n_hidden,
+                activation=self.activation,
+                dropout_prob=self.dropout_prob,
+            )
+            return
         self.model = RatioModel(
             n_observables=self.n_observables,
             n_hidden=self.n_hidden,
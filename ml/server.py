@@ -0,0 +1,411 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import time
+import socket
+import struct
+import logging
+import threading
+import socketserver
+import numpy as np
+from collections import deque
+from six.moves import queue
+
+logger = logging.getLogger(__name__)
+
+
+def _recv_exact(sock, n_bytes):
+    """ Receives exactly n_bytes into a new buffer, without intermediate copies """
+    buffer = bytearray(n_bytes)
+    view = memoryview(buffer)
+    position = 0
+    while position < n_bytes:
+        received = sock.recv_into(view[position:])
+        if received == 0:
+            raise EOFError("Connection closed")
+        position += received
+    return buffer
+
+
+def _send_frame(sock, header, arrays=()):
+    """ Sends a frame: the length of the JSON header as 4 byte little-endian integer, the header and raw arrays """
+    arrays = [np.ascontiguousarray(array) for array in arrays]
+    header = dict(header, nbytes=sum(array.nbytes for array in arrays))
+    header = json.dumps(header).encode("utf-8")
+    sock.sendall(struct.pack("<I", len(header)) + header)
+    for array in arrays:
+        sock.sendall(memoryview(array).cast("B"))
+
+
+def _recv_frame(sock):
+    """ Receives a frame sent with _send_frame, the payload of header["nbytes"] bytes is returned as raw buffer """
+    (header_length,) = struct.unpack("<I", bytes(_recv_exact(sock, 4)))
+    header = json.loads(_recv_exact(sock, header_length).decode("utf-8"))
+    payload = _recv_exact(sock, header.get("nbytes", 0))
+    return header, payload
+
+
+def _parse_address(address):
+    """
+    Returns ("tcp", (host, port)) for a (host, port) tuple or a "tcp:host:port" string, and ("unix", path) for a
+    "unix:path" string or any other path. The type is never guessed from the path, which may contain colons.
+    """
+    if isinstance(address, tuple):
+        host, port = address
+        return "tcp", (host, int(port))
+    if address.startswith("tcp:"):
+        host, port = address[len("tcp:"):].rsplit(":", 1)
+        return "tcp", (host, int(port))
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    return "unix", address
+
+
+class ServerMetrics(object):
+    """ Thread-safe throughput and latency counters of the inference server """
+
+    def __init__(self, n_latencies=10000):
+        self.lock = threading.Lock()
+        self.time_started = time.time()
+        self.n_requests = 0
+        self.n_events = 0
+        self.n_batches = 0
+        self.n_errors = 0
+        self.latencies = deque(maxlen=n_latencies)
+
+    def record_request(self, n_events, latency):
+        with self.lock:
+            self.n_requests += 1
+            self.n_events += n_events
+            self.latencies.append(latency)
+
+    def record_batch(self, failed=False):
+        with self.lock:
+            self.n_batches += 1
+            self.n_errors += int(failed)
+
+    def snapshot(self):
+        with self.lock:
+            uptime = time.time() - self.time_started
+            latencies = np.array(self.latencies) * 1000.0
+            metrics = {
+                "uptime": uptime,
+                "requests": self.n_requests,
+                "events": self.n_events,
+                "batches": self.n_batches,
+                "errors": self.n_errors,
+                "events_per_batch": self.n_events / max(self.n_batches, 1),
+                "events_per_second": self.n_events / max(uptime, 1.0e-9),
+            }
+        for quantile in [50, 90, 99]:
+            metrics["latency_ms_p{}".format(quantile)] = (
+                float(np.percentile(latencies, quantile)) if len(latencies) > 0 else None
+            )
+        return metrics
+
+
+class _Request(object):
+    def __init__(self, x):
+        self.x = x
+        self.time = time.time()
+        self.done = threading.Event()
+        self.r_hat = None
+        self.s_hat = None
+        self.error = None
+
+
+class ModelBatcher(object):
+    """
+    Collects the requests for one model and evaluates them together: a batch is closed once it holds
+    `max_batch_size` events or `max_latency` seconds after its first request arrived.
+    """
+
+    def __init__(self, estimator, metrics, max_batch_size=65536, max_latency=0.005, backend="torch", n_threads=None):
+        self.estimator = estimator
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.backend = backend
+        self.n_threads = n_threads
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def evaluate(self, x):
+        request = _Request(x)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.r_hat, request.s_hat
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            request = self.queue.get()
+            if request is None:
+                break
+
+            # Collect further requests until the batch is full or the first request waited long enough
+            requests = [request]
+            n_events = len(request.x)
+            deadline = request.time + self.max_latency
+            while n_events < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0.0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopped = True
+                    break
+                requests.append(request)
+                n_events += len(request.x)
+
+            try:
+                self._evaluate_batch(requests, n_events)
+            except Exception as e:
+                # Never leave clients waiting, the batcher keeps serving
+                logger.error("Batch of %s requests failed: %s", len(requests), e)
+                for request in requests:
+                    if not request.done.is_set():
+                        request.error = str(e)
+                        request.done.set()
+
+    def _evaluate_batch(self, requests, n_events):
+        error = None
+        try:
+            x = requests[0].x if len(requests) == 1 else np.concatenate([request.x for request in requests])
+            r_hat, s_hat = self.estimator.evaluate_ratio(
+                x, chunk_size=max(n_events, 1), backend=self.backend, n_threads=self.n_threads, cache=False
+            )
+            r_hat, s_hat = r_hat.astype(np.float32, copy=False), s_hat.astype(np.float32, copy=False)
+        except Exception as e:
+            logger.error("Evaluation of a batch of %s events failed: %s", n_events, e)
+            error = str(e)
+        self.metrics.record_batch(failed=error is not None)
+
+        # One bad request must not fail the others, so a failed batch is evaluated request by request
+        if error is not None and len(requests) > 1:
+            for request in requests:
+                self._evaluate_batch([request], len(request.x))
+            return
+
+        start = 0
+        for request in requests:
+            stop = start + len(request.x)
+            if error is None:
+                request.r_hat, request.s_hat = r_hat[start:stop], s_hat[start:stop]
+            request.error = error
+            start = stop
+            self.metrics.record_request(len(request.x), time.time() - request.time)
+            request.done.set()
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server.inference_server
+        while True:
+            try:
+                header, payload = _recv_frame(self.request)
+            except (EOFError, ConnectionError):
+                return
+
+            try:
+                operation = header.get("op", "evaluate")
+                if operation == "evaluate":
+                    # The observables are used in place of the received buffer
+                    batcher = server.batcher(header.get("model"))
+                    x = np.frombuffer(payload, dtype=np.float32).reshape(header["shape"])
+                    n_observables = batcher.estimator.n_observables
+                    if x.ndim != 2 or x.shape[1] != n_observables:
+                        raise ValueError(
+                            "Expected observables of shape (n_events, {}), got {}".format(n_observables, x.shape)
+                        )
+                    r_hat, s_hat = batcher.evaluate(x)
+                    _send_frame(self.request, {"status": "ok", "n_events": len(r_hat)}, [r_hat, s_hat])
+                elif operation == "metrics":
+                    _send_frame(self.request, {"status": "ok", "metrics": server.metrics.snapshot()})
+                elif operation == "models":
+                    _send_frame(self.request, {"status": "ok", "models": sorted(server.batchers.keys())})
+                else:
+                    raise ValueError("Unknown operation {}".format(operation))
+            except Exception as e:
+                _send_frame(self.request, {"status": "error", "error": str(e)})
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class InferenceServer(object):
+    """
+    Local inference server that keeps models loaded and batches the requests of many clients. It listens on a Unix
+    socket (a path) or on localhost TCP ("tcp:host:port"). The observables are sent as raw float32 buffers, see
+    `InferenceClient`. Batches bypass the evaluation cache: they mix the events of several small requests, so their
+    checksum would cost more than their evaluation and would hardly ever repeat.
+    Parameters
+    ----------
+    models : dict
+        Names and models (RatioEstimator instances or paths of saved models).
+    address : str or tuple, optional
+        Path of the Unix socket (optionally prefixed with "unix:"), "tcp:host:port" or a (host, port) tuple.
+        Default value: "/tmp/carl.sock".
+    max_batch_size : int, optional
+        Maximal number of events evaluated together. Default value: 65536.
+    max_latency : float, optional
+        Maximal time in seconds a request waits for further requests to be batched with. Default value: 0.005.
+    backend : {"torch", "onnxruntime"}, optional
+        Inference backend, see `RatioEstimator.evaluate_ratio()`. Default value: "torch".
+    n_threads : int or None, optional
+        Intra-op threads of the onnxruntime sessions. Default value: None.
+    """
+
+    def __init__(
+        self, models, address="/tmp/carl.sock", max_batch_size=65536, max_latency=0.005, backend="torch", n_threads=None
+    ):
+        from .ratio import RatioEstimator
+
+        self.address = address
+        self.family, self.socket_address = _parse_address(address)
+        self.metrics = ServerMetrics()
+        self.batchers = {}
+        for name, model in models.items():
+            if not isinstance(model, RatioEstimator):
+                logger.info("Loading model %s from %s", name, model)
+                filename = model
+                model = RatioEstimator()
+                model.load(filename)
+            self.batchers[name] = ModelBatcher(model, self.metrics, max_batch_size, max_latency, backend, n_threads)
+
+        if self.family == "tcp":
+            self.server = _TCPServer(self.socket_address, _RequestHandler)
+        else:
+            if os.path.exists(self.socket_address):
+                os.remove(self.socket_address)
+            self.server = _UnixServer(self.socket_address, _RequestHandler)
+        self.server.inference_server = self
+
+    def batcher(self, name=None):
+        if name is None and len(self.batchers) == 1:
+            return next(iter(self.batchers.values()))
+        if name not in self.batchers:
+            raise ValueError("Unknown model {}, available: {}".format(name, sorted(self.batchers.keys())))
+        return self.batchers[name]
+
+    def serve_forever(self):
+        logger.info("Serving %s on %s", sorted(self.batchers.keys()), self.address)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def close(self):
+        self.server.server_close()
+        for batcher in self.batchers.values():
+            batcher.stop()
+        if self.family == "unix" and os.path.exists(self.socket_address):
+            os.remove(self.socket_address)
+
+
+class InferenceClient(object):
+    """
+    Client of an `InferenceServer`, mirroring `RatioEstimator.evaluate()`. It only needs numpy, so clients start
+    without loading pyTorch or the model.
+    Parameters
+    ----------
+    address : str or tuple, optional
+        Path of the Unix socket (optionally prefixed with "unix:"), "tcp:host:port" or a (host, port) tuple.
+        Default value: "/tmp/carl.sock".
+    model : str or None, optional
+        Name of the model to evaluate. May be None if the server holds a single model. Default value: None.
+    timeout : float or None, optional
+        Socket timeout in seconds. Default value: None.
+    """
+
+    def __init__(self, address="/tmp/carl.sock", model=None, timeout=None):
+        self.address = address
+        self.model = model
+        self.timeout = timeout
+        self.sock = None
+
+    def _connect(self):
+        if self.sock is None:
+            family, socket_address = _parse_address(self.address)
+            if family == "tcp":
+                self.sock = socket.create_connection(socket_address, timeout=self.timeout)
+            else:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(self.timeout)
+                self.sock.connect(socket_address)
+        return self.sock
+
+    def _call(self, header, arrays=()):
+        sock = self._connect()
+        _send_frame(sock, header, arrays)
+        header, payload = _recv_frame(sock)
+        if header["status"] != "ok":
+            raise RuntimeError(header["error"])
+        return header, payload
+
+    def evaluate_ratio(self, x, model=None):
+        """
+        Evaluates the ratio as a function of the observation x.
+        Parameters
+        ----------
+        x : ndarray
+            Observations with shape `(n_samples, n_observables)`, sent as float32.
+        model : str or None, optional
+            Name of the model, overriding the one of the client. Default value: None.
+        Returns
+        -------
+        ratio : ndarray
+            The estimated ratio. It has shape `(n_samples,)`.
+        s_hat : ndarray
+            The classifier output. It has shape `(n_samples,)`.
+        """
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        header = {
+            "op": "evaluate",
+            "model": model if model is not None else self.model,
+            "shape": list(x.shape),
+        }
+        header, payload = self._call(header, [x])
+        outputs = np.frombuffer(payload, dtype=np.float32).reshape(2, header["n_events"])
+        return outputs[0], outputs[1]
+
+    def evaluate(self, *args, **kwargs):
+        return self.evaluate_ratio(*args, **kwargs)
+
+    def metrics(self):
+        return self._call({"op": "metrics"})[0]["metrics"]
+
+    def models(self):
+        return self._call({"op": "models"})[0]["models"]
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -2,20 +2,33 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import six
 import logging
+import os
+import json
+import inspect
 from collections import OrderedDict
+from six.moves import queue
 import numpy as np
 import time
+import threading
 import torch
 import torch.optim as optim
 from torch.utils.data import Dataset, DataLoader
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.sampler import Sampler, SubsetRandomSampler
 from torch.nn.utils import clip_grad_norm_
+
+from .models import EnsembleLinear
+from .functions import inference_mode
+from .utils.tools import available_cpus, create_missing_folders
 logger = logging.getLogger(__name__)
 
 class NanException(Exception):
     pass
 
 
+class EarlyStoppingException(Exception):
+    pass
+
+
 
 class NumpyDataset(Dataset):
     """ Dataset for numpy arrays with explicit memmap support """
@@ -54,10 +67,243 @@ class NumpyDataset(Dataset):
         return self.n
 
 
+class SubsetSequentialSampler(Sampler):
+    """ Samples the given indices in a fixed order, used for validation batches """
+
+    def __init__(self, indices):
+        self.indices = indices
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class BalancedEpochSampler(Sampler):
+    """
+    Draws a fresh, balanced subset of the training events every epoch: all events of the smaller class, plus
+    `ratio` times as many events of the larger class. The latter are either drawn uniformly without replacement,
+    or (with `importance=True`) with replacement and a probability proportional to `|w|`.
+
+    The weights of the drawn events are compensated in `reweight()`, such that the expected loss of an epoch equals
+    the weighted mean loss over the full training sample. Uniformly drawn events get `w * N_large / n_drawn`, importance
+    sampled ones `sign(w) * sum(|w|) / n_drawn`. All weights are in addition scaled by `n_epoch / N` to keep the loss
+    normalisation of a full epoch.
+    """
+
+    def __init__(self, indices, labels, weights=None, ratio=1.0, importance=False):
+        indices = np.asarray(indices)
+        labels = np.asarray(labels).reshape(-1)
+        classes, counts = np.unique(labels, return_counts=True)
+        if len(classes) != 2:
+            raise ValueError("Balanced sampling needs exactly two classes, found {}".format(classes))
+
+        self.large_label = classes[np.argmax(counts)]
+        self.small_indices = indices[labels != self.large_label]
+        self.large_indices = indices[labels == self.large_label]
+        self.importance = importance
+        self.n_drawn = int(min(len(self.large_indices), max(1, round(ratio * len(self.small_indices)))))
+
+        n_total = len(indices)
+        n_epoch = len(self.small_indices) + self.n_drawn
+        self.norm = n_epoch / float(n_total)
+        if importance:
+            if weights is None:
+                weights = np.ones(len(indices))
+            abs_weights = np.abs(np.asarray(weights).reshape(-1)[labels == self.large_label])
+            self.probabilities = abs_weights / abs_weights.sum()
+            self.large_factor = self.norm * abs_weights.sum() / self.n_drawn
+        else:
+            self.probabilities = None
+            self.large_factor = self.norm * len(self.large_indices) / float(self.n_drawn)
+
+        logger.info(
+            "Balanced epochs: %s of %s events of class %s %s with %s events of the other class",
+            self.n_drawn,
+            len(self.large_indices),
+            self.large_label,
+            "importance sampled by |w|" if importance else "drawn uniformly",
+            len(self.small_indices),
+        )
+
+    def __iter__(self):
+        drawn = np.random.choice(
+            self.large_indices, size=self.n_drawn, replace=self.importance, p=self.probabilities
+        )
+        epoch_indices = np.concatenate((self.small_indices, drawn))
+        np.random.shuffle(epoch_indices)
+        return iter(epoch_indices.tolist())
+
+    def __len__(self):
+        return len(self.small_indices) + self.n_drawn
+
+    def reweight(self, batch_data):
+        y, w = batch_data["y"], batch_data["w"]
+        if w is None:
+            w = torch.ones_like(y)
+        large = y == float(self.large_label)
+        if self.importance:
+            w_large = torch.sign(w) * self.large_factor
+        else:
+            w_large = w * self.large_factor
+        batch_data["w"] = torch.where(large, w_large, w * self.norm)
+        return batch_data
+
+
+class ProgressiveSampler(Sampler):
+    """
+    Trains on a growing, nested random subset of the training events, e.g. 10% -> 30% -> 100%. The subset of a
+    stage contains the ones of all earlier stages. Stages either start at fixed epochs (`start_epochs`), or advance
+    once the validation loss has not improved for `patience` epochs within the current stage. A uniform subsample
+    keeps the weighted loss unbiased, so no weight compensation is needed.
+    """
+
+    def __init__(self, indices, fractions=(0.1, 0.3, 1.0), start_epochs=None, patience=2):
+        if start_epochs is not None and len(start_epochs) != len(fractions):
+            raise ValueError("Need one start epoch per progressive fraction")
+        self.permutation = np.random.permutation(np.asarray(indices))
+        self.fractions = list(fractions)
+        self.start_epochs = None if start_epochs is None else list(start_epochs)
+        self.patience = patience
+        self.stage = 0
+        self._reset_plateau()
+        self._log_stage()
+
+    @property
+    def final_stage(self):
+        return self.stage == len(self.fractions) - 1
+
+    def set_epoch(self, i_epoch):
+        if self.start_epochs is None:
+            return
+        while not self.final_stage and self.start_epochs[self.stage + 1] <= i_epoch:
+            self.advance()
+
+    def update(self, loss_val, i_epoch):
+        """ Tracks the validation loss and advances to the next stage on a plateau """
+        if self.start_epochs is not None or loss_val is None:
+            return
+        if self.best_loss is None or loss_val < self.best_loss:
+            self.best_loss, self.best_epoch = loss_val, i_epoch
+        elif i_epoch - self.best_epoch >= self.patience:
+            self.advance()
+
+    def advance(self):
+        if self.final_stage:
+            return False
+        self.stage += 1
+        self._reset_plateau()
+        self._log_stage()
+        return True
+
+    def _reset_plateau(self):
+        self.best_loss, self.best_epoch = None, None
+
+    def _log_stage(self):
+        logger.info(
+            "Progressive training stage %s: %s of %s training events",
+            self.stage + 1,
+            len(self),
+            len(self.permutation),
+        )
+
+    def __iter__(self):
+        subset = self.permutation[: len(self)].copy()
+        np.random.shuffle(subset)
+        return iter(subset.tolist())
+
+    def __len__(self):
+        return max(1, int(round(self.fractions[self.stage] * len(self.permutation))))
+
+    def reweight(self, batch_data):
+        return batch_data
+
+
+class BatchPrefetcher(object):
+    """
+    Wraps a DataLoader and prepares the next batches on a background thread while the current one is trained on:
+    dtype conversion, pinned-memory staging and (on GPU) the asynchronous host-to-device copy on a separate CUDA
+    stream. On the CPU the batch assembly and conversion still overlap with the compute of the previous batch.
+    """
+
+    _end = object()
+
+    def __init__(self, loader, device, dtype, n_prefetch=2):
+        self.loader = loader
+        self.device = device
+        self.dtype = dtype
+        self.n_prefetch = n_prefetch
+        self.use_cuda = device.type == "cuda"
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _stage(self, batch, stream):
+        if not self.use_cuda:
+            return tuple(tensor.to(self.dtype) for tensor in batch), None
+
+        with torch.cuda.stream(stream):
+            staged = []
+            for tensor in batch:
+                if not tensor.is_pinned():
+                    tensor = tensor.pin_memory()
+                staged.append(tensor.to(self.device, self.dtype, non_blocking=True))
+            event = torch.cuda.Event()
+            event.record(stream)
+        return tuple(staged), event
+
+    @staticmethod
+    def _put(batches, item, stop):
+        """ Puts an item into the queue unless the consumer stopped, returns whether it was put """
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, batches, stream, stop):
+        try:
+            for batch in self.loader:
+                if not self._put(batches, self._stage(batch, stream), stop):
+                    return
+        except Exception as e:
+            self._put(batches, e, stop)
+            return
+        self._put(batches, self._end, stop)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.n_prefetch)
+        stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stream, stop))
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                item = batches.get()
+                if item is self._end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    for tensor in batch:
+                        tensor.record_stream(current_stream)
+                yield batch
+        finally:
+            stop.set()
+
+
 class Trainer(object):
     """ Trainer class. Any subclass has to implement the forward_pass() function. """
 
-    def __init__(self, model, run_on_gpu=True, double_precision=False, n_workers=8):
+    def __init__(self, model, run_on_gpu=True, double_precision=False, n_workers=8, n_threads=None):
         self._init_timer()
         self._timer(start="ALL")
         self._timer(start="initialize model")
@@ -66,6 +312,10 @@ class Trainer(object):
         self.device = torch.device("cuda" if self.run_on_gpu else "cpu")
         self.dtype = torch.double if double_precision else torch.float
         self.n_workers = n_workers
+        self.n_threads = n_threads
+        self.epoch_sampler = None
+        if n_threads is not None:
+            torch.set_num_threads(n_threads)
         self.model = self.model.to(self.device, self.dtype)
 
         logger.info(
@@ -96,6 +346,19 @@ class Trainer(object):
         early_stopping_patience=None,
         clip_gradient=None,
         verbose="some",
+        micro_batch_size=None,
+        memory_budget_gb=None,
+        prefetch=False,
+        validate_every=1,
+        n_validation_samples=None,
+        autotune=False,
+        autotune_profile=None,
+        autotune_batch_sizes=None,
+        balance_ratio=None,
+        balance_importance=False,
+        progressive_fractions=None,
+        progressive_epochs=None,
+        progressive_patience=2,
     ):
         self._timer(start="ALL")
         self._timer(start="check data")
@@ -108,13 +371,53 @@ class Trainer(object):
             _, dataset_val = self.make_dataset(data_val)
         else:
             dataset_val = None
+        if autotune:
+            self._timer(stop="make dataset", start="autotune")
+            batch_size = self.autotune(
+                dataset,
+                data_labels,
+                loss_functions,
+                loss_weights,
+                batch_sizes=autotune_batch_sizes or [batch_size],
+                profile=autotune_profile,
+            )
+            self._timer(stop="autotune", start="make dataset")
         self._timer(stop="make dataset", start="make dataloader")
-        train_loader, val_loader = self.make_dataloaders(dataset, dataset_val, validation_split, batch_size)
+        train_sampler_factory = self.make_train_sampler_factory(
+            data,
+            balance_ratio,
+            balance_importance,
+            progressive_fractions,
+            progressive_epochs,
+            progressive_patience,
+        )
+        train_loader, val_loader = self.make_dataloaders(
+            dataset, dataset_val, validation_split, batch_size, n_validation_samples, train_sampler_factory
+        )
+        if prefetch:
+            logger.debug("Prefetching batches on a background thread")
+            train_loader = BatchPrefetcher(train_loader, self.device, self.dtype)
+            if val_loader is not None:
+                val_loader = BatchPrefetcher(val_loader, self.device, self.dtype)
+        if micro_batch_size == "auto":
+            micro_batch_size = self.auto_micro_batch_size(dataset, batch_size, memory_budget_gb)
+        if micro_batch_size is not None and micro_batch_size < batch_size:
+            logger.debug(
+                "Accumulating gradients over %s micro-batches of size %s",
+                int(np.ceil(batch_size / micro_batch_size)),
+                micro_batch_size,
+            )
+        else:
+            micro_batch_size = None
+
+        progressive = self.epoch_sampler if isinstance(self.epoch_sampler, ProgressiveSampler) else None
+        if progressive is not None and progressive_epochs is None and val_loader is None:
+            raise ValueError("Progressive training on validation loss plateaus needs validation data")
 
         self._timer(stop="make dataloader", start="setup optimizer")
         logger.debug("Setting up optimizer")
         optimizer_kwargs = {} if optimizer_kwargs is None else optimizer_kwargs
-        opt = optimizer(self.model.parameters(), lr=initial_lr, **optimizer_kwargs)
+        opt = optimizer([p for p in self.model.parameters() if p.requires_grad], lr=initial_lr, **optimizer_kwargs)
         early_stopping = early_stopping and (validation_split is not None) and (epochs > 1)
         best_loss, best_model, best_epoch = None, None, None
         if early_stopping and early_stopping_patience is None:
@@ -143,8 +446,12 @@ class Trainer(object):
             raise ValueError("Unknown value %s for keyword verbose", verbose)
         logger.debug("Will print training progress every %s epochs", n_epochs_verbose)
 
+        if val_loader is not None and validate_every > 1:
+            logger.debug("Validating every %s epochs", validate_every)
+
         logger.debug("Beginning main training loop")
         losses_train, losses_val = [], []
+        last_loss_val = None
         self._timer(stop="initialize training")
 
         # Loop over epochs
@@ -155,27 +462,47 @@ class Trainer(object):
             self.set_lr(opt, lr)
             logger.debug("Learning rate: %s", lr)
             self._timer(stop="set lr")
+            if progressive is not None:
+                progressive.set_epoch(i_epoch)
             loss_val = None
+            # Always validate after the last epoch, so that early stopping can be wrapped up
+            validate = (i_epoch + 1) % validate_every == 0 or i_epoch == epochs - 1
 
             try:
                 loss_train, loss_val, loss_contributions_train, loss_contributions_val = self.epoch(
-                    i_epoch, data_labels, train_loader, val_loader, opt, loss_functions, loss_weights, clip_gradient
+                    i_epoch,
+                    data_labels,
+                    train_loader,
+                    val_loader if validate else None,
+                    opt,
+                    loss_functions,
+                    loss_weights,
+                    clip_gradient,
+                    micro_batch_size,
                 )
                 losses_train.append(loss_train)
-                losses_val.append(loss_val)
+                losses_val.append(np.nan if loss_val is None else loss_val)
             except NanException:
                 logger.info("Ending training during epoch %s because NaNs appeared", i_epoch + 1)
                 break
 
             self._timer(start="early stopping")
-            if early_stopping:
+            if loss_val is not None:
+                last_loss_val = loss_val
+            if early_stopping and loss_val is not None:
                 try:
                     best_loss, best_model, best_epoch = self.check_early_stopping(
                         best_loss, best_model, best_epoch, loss_val, i_epoch, early_stopping_patience
                     )
                 except EarlyStoppingException:
-                    logger.info("Early stopping: ending training after %s epochs", i_epoch + 1)
-                    break
+                    # Before training on the full sample, a stalled validation loss moves on to the next stage
+                    if progressive is not None and np.isfinite(loss_val) and progressive.advance():
+                        best_epoch = i_epoch
+                    else:
+                        logger.info("Early stopping: ending training after %s epochs", i_epoch + 1)
+                        break
+            if progressive is not None:
+                progressive.update(loss_val, i_epoch)
             self._timer(stop="early stopping", start="report epoch")
 
             verbose_epoch = (i_epoch + 1) % n_epochs_verbose == 0
@@ -191,8 +518,8 @@ class Trainer(object):
             self._timer(stop="report epoch")
 
         self._timer(start="early stopping")
-        if early_stopping and len(losses_val) > 0:
-            self.wrap_up_early_stopping(best_model, loss_val, best_loss, best_epoch)
+        if early_stopping and last_loss_val is not None:
+            self.wrap_up_early_stopping(best_model, last_loss_val, best_loss, best_epoch)
         self._timer(stop="early stopping")
 
         logger.debug("Training finished")
@@ -223,6 +550,41 @@ class Trainer(object):
     def check_data(data):
         pass
 
+    def make_train_sampler_factory(
+        self,
+        data,
+        balance_ratio=None,
+        balance_importance=False,
+        progressive_fractions=None,
+        progressive_epochs=None,
+        progressive_patience=2,
+    ):
+        """ Per-epoch training sampler, or None to shuffle the full training sample every epoch """
+        if balance_ratio is not None and progressive_fractions is not None:
+            raise ValueError("Balanced and progressive epoch sampling cannot be combined")
+
+        if progressive_fractions is not None:
+            return lambda train_idx: ProgressiveSampler(
+                train_idx, progressive_fractions, start_epochs=progressive_epochs, patience=progressive_patience
+            )
+
+        if balance_ratio is None:
+            return None
+
+        labels = np.asarray(data["y"]).reshape(-1)
+        weights = None if data.get("w") is None else np.asarray(data["w"]).reshape(-1)
+
+        def factory(train_idx):
+            return BalancedEpochSampler(
+                train_idx,
+                labels[train_idx],
+                None if weights is None else weights[train_idx],
+                ratio=balance_ratio,
+                importance=balance_importance,
+            )
+
+        return factory
+
     def make_dataset(self, data):
         data_arrays = []
         data_labels = []
@@ -232,19 +594,21 @@ class Trainer(object):
         dataset = NumpyDataset(*data_arrays, dtype=self.dtype, run_on_gpu=self.run_on_gpu)
         return data_labels, dataset
 
-    def make_dataloaders(self, dataset, dataset_val, validation_split, batch_size):
+    def make_dataloaders(
+        self, dataset, dataset_val, validation_split, batch_size, n_validation_samples=None, train_sampler_factory=None
+    ):
         if dataset_val is None and (validation_split is None or validation_split <= 0.0):
-            train_loader = DataLoader(
-                dataset, batch_size=batch_size, shuffle=True, pin_memory=self.run_on_gpu, num_workers=self.n_workers
-            )
+            train_loader = self._train_dataloader(dataset, list(range(len(dataset))), batch_size, train_sampler_factory)
             val_loader = None
 
         elif dataset_val is not None:
-            train_loader = DataLoader(
-                dataset, batch_size=batch_size, shuffle=True, pin_memory=self.run_on_gpu, num_workers=self.n_workers
-            )
+            train_loader = self._train_dataloader(dataset, list(range(len(dataset))), batch_size, train_sampler_factory)
+            valid_idx = self._validation_subsample(list(range(len(dataset_val))), n_validation_samples)
             val_loader = DataLoader(
-                dataset_val, batch_size=batch_size, shuffle=True, pin_memory=self.run_on_gpu, num_workers=self.n_workers
+                dataset_val,
+                sampler=SubsetSequentialSampler(valid_idx),
+                batch_size=batch_size,
+                **self._loader_kwargs()
             )
 
         else:
@@ -255,27 +619,189 @@ class Trainer(object):
             split = int(np.floor(validation_split * n_samples))
             np.random.shuffle(indices)
             train_idx, valid_idx = indices[split:], indices[:split]
+            valid_idx = self._validation_subsample(valid_idx, n_validation_samples)
 
-            train_sampler = SubsetRandomSampler(train_idx)
-            val_sampler = SubsetRandomSampler(valid_idx)
+            val_sampler = SubsetSequentialSampler(valid_idx)
 
-            train_loader = DataLoader(
-                dataset,
-                sampler=train_sampler,
-                batch_size=batch_size,
-                pin_memory=self.run_on_gpu,
-                num_workers=self.n_workers,
-            )
+            train_loader = self._train_dataloader(dataset, train_idx, batch_size, train_sampler_factory)
             val_loader = DataLoader(
                 dataset,
                 sampler=val_sampler,
                 batch_size=batch_size,
-                pin_memory=self.run_on_gpu,
-                num_workers=self.n_workers,
+                **self._loader_kwargs()
             )
 
         return train_loader, val_loader
 
+    def _train_dataloader(self, dataset, train_idx, batch_size, train_sampler_factory=None):
+        if train_sampler_factory is None:
+            self.epoch_sampler = None
+            train_sampler = SubsetRandomSampler(train_idx)
+        else:
+            self.epoch_sampler = train_sampler_factory(np.asarray(train_idx))
+            train_sampler = self.epoch_sampler
+        return DataLoader(dataset, sampler=train_sampler, batch_size=batch_size, **self._loader_kwargs())
+
+    def _loader_kwargs(self):
+        kwargs = {"pin_memory": self.run_on_gpu, "num_workers": self.n_workers}
+        # Keep the worker processes alive between epochs where pyTorch supports it
+        if self.n_workers > 0 and "persistent_workers" in inspect.signature(DataLoader.__init__).parameters:
+            kwargs["persistent_workers"] = True
+        return kwargs
+
+    def autotune(
+        self,
+        dataset,
+        data_labels,
+        loss_functions,
+        loss_weights,
+        batch_sizes,
+        n_workers_candidates=None,
+        n_threads_candidates=None,
+        n_samples=100000,
+        n_batches=10,
+        profile=None,
+    ):
+        """
+        Short calibration phase that benchmarks combinations of DataLoader workers, intra-op threads and batch size
+        on a sample of the training data, and applies the configuration with the highest throughput. Only the CPUs
+        in the affinity mask of the job are used. If `profile` is an existing file made for the same number of CPUs,
+        the configuration saved there is reused instead, otherwise the chosen configuration is saved to it.
+        Returns
+        -------
+        batch_size : int
+            The selected batch size. The number of workers and threads are set on the trainer.
+        """
+        n_cpus = available_cpus()
+        if profile is not None and os.path.isfile(profile):
+            with open(profile, "r") as f:
+                config = json.load(f)
+            # A profile tuned on a node with a different number of CPUs would over- or undersubscribe this one
+            if config.get("n_cpus") != n_cpus:
+                logger.info(
+                    "Autotune profile %s was made for %s CPUs, not %s, benchmarking again",
+                    profile,
+                    config.get("n_cpus"),
+                    n_cpus,
+                )
+            else:
+                logger.info(
+                    "Using autotune profile %s: %s workers, %s threads, batch size %s",
+                    profile,
+                    config["n_workers"],
+                    config["n_threads"],
+                    config["batch_size"],
+                )
+                self._apply_loader_config(config)
+                return config["batch_size"]
+
+        if n_workers_candidates is None:
+            n_workers_candidates = [n for n in [0, 1, 2, 4, 8] if n < n_cpus]
+        if n_threads_candidates is None:
+            n_threads_candidates = sorted(set(n for n in [1, 2, 4, n_cpus] if n <= n_cpus))
+
+        indices = np.random.choice(len(dataset), size=min(n_samples, len(dataset)), replace=False)
+        model_state = OrderedDict(
+            (key, value.detach().clone()) for key, value in six.iteritems(self.model.state_dict())
+        )
+        optimizer = torch.optim.SGD(self.model.parameters(), lr=0.0)
+        n_workers_before, n_threads_before = self.n_workers, torch.get_num_threads()
+        timer_before = self.timer.copy()
+
+        results = []
+        for batch_size in batch_sizes:
+            for n_workers in n_workers_candidates:
+                for n_threads in n_threads_candidates:
+                    # Workers and intra-op threads share the available CPUs
+                    if n_workers > 0 and n_workers + n_threads > n_cpus:
+                        continue
+                    self.n_workers = n_workers
+                    torch.set_num_threads(n_threads)
+                    loader = DataLoader(
+                        dataset, sampler=SubsetRandomSampler(indices), batch_size=batch_size, **self._loader_kwargs()
+                    )
+                    throughput = self._benchmark_loader(
+                        loader, data_labels, loss_functions, loss_weights, optimizer, n_batches
+                    )
+                    del loader
+                    logger.debug(
+                        "  Autotune: %s workers, %s threads, batch size %s: %.0f events / s",
+                        n_workers,
+                        n_threads,
+                        batch_size,
+                        throughput,
+                    )
+                    results.append((throughput, n_workers, n_threads, batch_size))
+
+        self.model.load_state_dict(model_state)
+        self.timer = timer_before
+        # A throughput of 0 means that no batch was timed, e.g. because the sample has fewer than two batches
+        results = [result for result in results if result[0] > 0.0]
+        if not results:
+            logger.warning(
+                "Autotune measured no throughput for any configuration, keeping %s workers, %s threads and batch "
+                "size %s",
+                n_workers_before,
+                n_threads_before,
+                batch_sizes[0],
+            )
+            self.n_workers = n_workers_before
+            torch.set_num_threads(n_threads_before)
+            return batch_sizes[0]
+
+        throughput, n_workers, n_threads, batch_size = max(results)
+        config = {
+            "n_workers": n_workers,
+            "n_threads": n_threads,
+            "batch_size": batch_size,
+            "throughput": throughput,
+            "n_cpus": n_cpus,
+        }
+        logger.info(
+            "Autotune chose %s workers, %s threads and batch size %s (%.0f events / s on %s CPUs)",
+            n_workers,
+            n_threads,
+            batch_size,
+            throughput,
+            n_cpus,
+        )
+        if profile is not None:
+            create_missing_folders([os.path.dirname(profile)])
+            with open(profile, "w") as f:
+                json.dump(config, f)
+        self._apply_loader_config(config)
+        return batch_size
+
+    def _apply_loader_config(self, config):
+        self.n_workers = int(config["n_workers"])
+        self.n_threads = int(config["n_threads"])
+        torch.set_num_threads(self.n_threads)
+
+    def _benchmark_loader(self, loader, data_labels, loss_functions, loss_weights, optimizer, n_batches):
+        self.model.train()
+        n_events, time_started = 0, None
+        for i_batch, batch_data in enumerate(loader):
+            batch_data = OrderedDict(list(zip(data_labels, batch_data)))
+            self.batch_train(batch_data, loss_functions, loss_weights, optimizer)
+            # The first batch includes the worker start-up and is not timed
+            if i_batch == 0:
+                time_started = time.time()
+            else:
+                n_events += len(batch_data[data_labels[0]])
+            if i_batch >= n_batches:
+                break
+        if time_started is None or n_events == 0:
+            return 0.0
+        return n_events / max(time.time() - time_started, 1.0e-9)
+
+    @staticmethod
+    def _validation_subsample(indices, n_validation_samples):
+        """ Fixed random subset of the validation indices, kept sorted for sequential reads """
+        if n_validation_samples is not None and n_validation_samples < len(indices):
+            indices = np.random.choice(indices, size=n_validation_samples, replace=False)
+            logger.debug("Validating on a fixed subsample of %s events", n_validation_samples)
+        return sorted(indices)
+
     @staticmethod
     def calculate_lr(i_epoch, n_epochs, initial_lr, final_lr):
         if n_epochs == 1:
@@ -297,6 +823,7 @@ class Trainer(object):
         loss_functions,
         loss_weights,
         clip_gradient=None,
+        micro_batch_size=None,
     ):
         n_losses = len(loss_functions)
 
@@ -306,9 +833,11 @@ class Trainer(object):
         self._timer(start="load training batch")
         for i_batch, batch_data in enumerate(train_loader):
             batch_data = OrderedDict(list(zip(data_labels, batch_data)))
+            if self.epoch_sampler is not None:
+                batch_data = self.epoch_sampler.reweight(batch_data)
             self._timer(stop="load training batch")
             batch_loss, batch_loss_contributions = self.batch_train(
-                batch_data, loss_functions, loss_weights, optimizer, clip_gradient
+                batch_data, loss_functions, loss_weights, optimizer, clip_gradient, micro_batch_size
             )
             loss_train += batch_loss
             for i, batch_loss_contribution in enumerate(batch_loss_contributions):
@@ -349,7 +878,12 @@ class Trainer(object):
 
         return loss_train, loss_val, loss_contributions_train, loss_contributions_val
 
-    def batch_train(self, batch_data, loss_functions, loss_weights, optimizer, clip_gradient=None):
+    def batch_train(self, batch_data, loss_functions, loss_weights, optimizer, clip_gradient=None, micro_batch_size=None):
+        if micro_batch_size is not None:
+            return self.batch_train_accumulated(
+                batch_data, loss_functions, loss_weights, optimizer, clip_gradient, micro_batch_size
+            )
+
         self._timer(start="training forward pass")
         loss_contributions = self.forward_pass(batch_data, loss_functions)
         self._timer(stop="training forward pass", start="training sum losses")
@@ -365,9 +899,85 @@ class Trainer(object):
 
         return loss, loss_contributions
 
+    def batch_train_accumulated(
+        self, batch_data, loss_functions, loss_weights, optimizer, clip_gradient, micro_batch_size
+    ):
+        """
+        Gradient accumulation over micro-batches of one batch. The weighted losses are means over the events of
+        each micro-batch, so every micro-batch loss is scaled by its share of the batch. The accumulated gradient is
+        then identical to the one of a single forward / backward pass over the full batch.
+        """
+        n_batch = len(next(iter(batch_data.values())))
+        loss = 0.0
+        loss_contributions = np.zeros(len(loss_functions))
+
+        self._timer(start="opt: zero grad")
+        optimizer.zero_grad()
+        self._timer(stop="opt: zero grad")
+
+        for start in range(0, n_batch, micro_batch_size):
+            micro_batch_data = OrderedDict(
+                (key, value[start : start + micro_batch_size]) for key, value in six.iteritems(batch_data)
+            )
+            fraction = min(micro_batch_size, n_batch - start) / float(n_batch)
+
+            self._timer(start="training forward pass")
+            micro_loss_contributions = self.forward_pass(micro_batch_data, loss_functions)
+            self._timer(stop="training forward pass", start="training sum losses")
+            micro_loss = fraction * self.sum_losses(micro_loss_contributions, loss_weights)
+            self._timer(stop="training sum losses", start="opt: backward")
+            micro_loss.backward()
+            self._timer(stop="opt: backward", start="training sum losses")
+
+            loss += micro_loss.item()
+            for i, contrib in enumerate(micro_loss_contributions):
+                loss_contributions[i] += fraction * contrib.item()
+            self._timer(stop="training sum losses")
+
+        self._timer(start="opt: clip grad norm")
+        if clip_gradient is not None:
+            clip_grad_norm_(self.model.parameters(), clip_gradient)
+        self._timer(stop="opt: clip grad norm", start="opt: step")
+        optimizer.step()
+        self._timer(stop="opt: step")
+
+        return loss, list(loss_contributions)
+
+    def auto_micro_batch_size(self, dataset, batch_size, memory_budget_gb):
+        """
+        Largest micro-batch size whose forward / backward pass fits into `memory_budget_gb`. Per event we count the
+        input, and the pre-activation, activation and gradient of every layer output; the parameters are counted
+        four times (values, gradients and two optimizer moments).
+        """
+        if memory_budget_gb is None:
+            raise ValueError("micro_batch_size='auto' requires a memory_budget_gb")
+
+        element_size = torch.tensor([], dtype=self.dtype).element_size()
+        n_inputs = int(np.prod(dataset[0][0].shape))
+
+        floats_per_event = n_inputs
+        for module in self.model.modules():
+            if isinstance(module, torch.nn.Linear):
+                floats_per_event += 3 * module.out_features
+            elif isinstance(module, EnsembleLinear):
+                floats_per_event += 3 * module.n_members * module.out_features
+        n_parameters = sum(p.numel() for p in self.model.parameters())
+
+        budget = memory_budget_gb * 1024 ** 3 - 4 * n_parameters * element_size
+        micro_batch_size = int(budget // (floats_per_event * element_size))
+        micro_batch_size = max(1, min(batch_size, micro_batch_size))
+        logger.info(
+            "Micro-batch size %s chosen for a memory budget of %s GB (%s bytes per event)",
+            micro_batch_size,
+            memory_budget_gb,
+            floats_per_event * element_size,
+        )
+        return micro_batch_size
+
     def batch_val(self, batch_data, loss_functions, loss_weights):
         self._timer(start="validation forward pass")
-        loss_contributions = self.forward_pass(batch_data, loss_functions)
+        with inference_mode():
+            loss_contributions = self.forward_pass(batch_data, loss_functions)
         self._timer(stop="validation forward pass", start="validation sum losses")
         loss = self.sum_losses(loss_contributions, loss_weights)
 
@@ -415,7 +1025,10 @@ class Trainer(object):
     def check_early_stopping(self, best_loss, best_model, best_epoch, loss, i_epoch, early_stopping_patience=None):
         if best_loss is None or loss < best_loss:
             best_loss = loss
-            best_model = self.model.state_dict()
+            # state_dict() returns references to the live parameters, keep a copy
+            best_model = OrderedDict(
+                (key, value.detach().clone()) for key, value in six.iteritems(self.model.state_dict())
+            )
             best_epoch = i_epoch
 
         if early_stopping_patience is not None and i_epoch - best_epoch > early_stopping_patience >= 0:
@@ -508,8 +1121,8 @@ class Trainer(object):
 
 
 class RatioTrainer(Trainer):
-    def __init__(self, model, run_on_gpu=True, double_precision=False, n_workers=8):
-        super(RatioTrainer, self).__init__(model, run_on_gpu, double_precision, n_workers)
+    def __init__(self, model, run_on_gpu=True, double_precision=False, n_workers=8, n_threads=None):
+        super(RatioTrainer, self).__init__(model, run_on_gpu, double_precision, n_workers, n_threads)
 
     def check_data(self, data):
         data_keys = list(data.keys())
@@ -523,14 +1136,15 @@ class RatioTrainer(Trainer):
         self._timer(stop="fwd: move data", start="fwd: check for nans")
         self._timer(start="fwd: model.forward", stop="fwd: check for nans")
 
-        r_hat, s_hat= self.model(x)
+        # Only the logits are needed for the loss, r_hat and s_hat are formed at evaluation
+        logit = self.model.logits(x)
 
         self._timer(stop="fwd: model.forward", start="fwd: check for nans")
-        self._check_for_nans("Model output", s_hat, r_hat)
+        self._check_for_nans("Model output", logit)
 
         self._timer(start="fwd: calculate losses", stop="fwd: check for nans")
         losses = [
-            loss_function(s_hat, y, w) for loss_function in loss_functions
+            loss_function(logit, y, w) for loss_function in loss_functions
         ]
         self._timer(stop="fwd: calculate losses", start="fwd: check for nans")
         self._check_for_nans("Loss", *losses)
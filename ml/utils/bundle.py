@@ -0,0 +1,152 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import struct
+import hashlib
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CARLBNDL"
+VERSION = 1
+ALIGNMENT = 64
+CACHE_SIZE = 8
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_bundle(filename, metadata, arrays):
+    """
+    Writes a single-file bundle: an 8 byte magic string, the length of the JSON header as 8 byte little-endian
+    integer, the header with the metadata and the dtype, shape, offset and sha256 checksum of every array, and the raw
+    arrays, each aligned to 64 bytes so that they can be memory mapped. The file is written under a temporary name and
+    then moved into place.
+    Parameters
+    ----------
+    filename : str
+        Path of the bundle.
+    metadata : dict
+        JSON serialisable metadata.
+    arrays : dict of ndarray
+        Named arrays.
+    Returns
+    -------
+        None
+    """
+    arrays = OrderedDict((name, np.ascontiguousarray(array)) for name, array in arrays.items())
+
+    # Layout of the arrays relative to the start of the data section
+    entries = OrderedDict()
+    offset = 0
+    for name, array in arrays.items():
+        entries[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+            "sha256": hashlib.sha256(array.tobytes()).hexdigest(),
+        }
+        offset = _aligned(offset + array.nbytes)
+
+    header = json.dumps({"version": VERSION, "metadata": metadata, "arrays": entries}).encode("utf-8")
+    data_start = _aligned(len(MAGIC) + 8 + len(header))
+
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + entries[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_filename, filename)
+
+
+def _read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise RuntimeError("{} is not a model bundle".format(f.name))
+    (header_length,) = struct.unpack("<Q", f.read(8))
+    header_bytes = f.read(header_length)
+    return header_bytes, _aligned(len(MAGIC) + 8 + header_length)
+
+
+def bundle_checksum(filename):
+    """ Checksum of a bundle, computed from its header only (which contains the checksums of all arrays) """
+    with open(filename, "rb") as f:
+        header_bytes, _ = _read_header(f)
+    return hashlib.sha256(header_bytes).hexdigest()
+
+
+def read_bundle(filename, mmap=True, verify=True):
+    """
+    Reads a bundle written with `write_bundle()`.
+    Parameters
+    ----------
+    filename : str
+        Path of the bundle.
+    mmap : bool, optional
+        If True, the arrays are read-only memory maps of the file. Default value: True.
+    verify : bool, optional
+        If True, the sha256 checksums of all arrays are verified. Default value: True.
+    Returns
+    -------
+    metadata : dict
+        The metadata.
+    arrays : OrderedDict of ndarray
+        The named arrays.
+    """
+    with open(filename, "rb") as f:
+        header_bytes, data_start = _read_header(f)
+        header = json.loads(header_bytes.decode("utf-8"))
+        if header["version"] > VERSION:
+            raise RuntimeError("Bundle {} has the unsupported version {}".format(filename, header["version"]))
+
+        arrays = OrderedDict()
+        for name, entry in header["arrays"].items():
+            dtype = np.dtype(entry["dtype"])
+            shape = tuple(entry["shape"])
+            if mmap and int(np.prod(shape)) > 0:
+                array = np.memmap(f, dtype=dtype, mode="r", offset=data_start + entry["offset"], shape=shape)
+            else:
+                f.seek(data_start + entry["offset"])
+                array = np.frombuffer(f.read(int(np.prod(shape)) * dtype.itemsize), dtype=dtype).reshape(shape)
+            if verify and hashlib.sha256(np.ascontiguousarray(array).tobytes()).hexdigest() != entry["sha256"]:
+                raise RuntimeError("Checksum of {} in bundle {} does not match".format(name, filename))
+            arrays[name] = array
+
+    return header["metadata"], arrays
+
+
+def load_bundle(filename):
+    """
+    Reads a bundle through a process-wide LRU cache of the last `CACHE_SIZE` bundles, keyed by the absolute path and
+    the checksum, so that the arrays of an unchanged bundle are only read and verified once. The arrays are read-only
+    memory maps.
+    """
+    key = (os.path.abspath(filename), bundle_checksum(filename))
+    with _cache_lock:
+        if key in _cache:
+            logger.debug("Bundle %s found in cache", filename)
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    bundle = read_bundle(filename, mmap=True, verify=True)
+    with _cache_lock:
+        _cache[key] = bundle
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return bundle
+
+
+def clear_bundle_cache():
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,119 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import time
+import hashlib
+import logging
+import numpy as np
+import six
+
+logger = logging.getLogger(__name__)
+
+OUTPUTS = ["r_hat", "s_hat", "r_hat_std"]
+
+
+def data_fingerprint(x):
+    """
+    Fingerprint of evaluation data: the absolute path, size and modification time of a file, or a blake2b checksum of
+    the content of an array, which is considerably faster than sha256 on large arrays.
+    """
+    if isinstance(x, six.string_types):
+        status = os.stat(x)
+        return "file:{}:{}:{}".format(os.path.abspath(x), status.st_size, status.st_mtime_ns)
+    x = np.ascontiguousarray(x)
+    checksum = hashlib.blake2b(digest_size=32)
+    checksum.update("{}:{}".format(x.dtype.str, x.shape).encode("utf-8"))
+    checksum.update(memoryview(x).cast("B"))
+    return "array:" + checksum.hexdigest()
+
+
+class EvaluationCache(object):
+    """
+    Persistent cache of evaluation results, keyed by the model checksum, the data fingerprint and the backend. Every
+    entry is a set of .npy files that are returned as read-only memory maps. When the cache grows beyond
+    `max_size_gb`, the least recently used entries are removed.
+    Parameters
+    ----------
+    folder : str or None, optional
+        Cache folder. If None, $CARL_CACHE_DIR or ~/.cache/carl-torch. Default value: None.
+    max_size_gb : float, optional
+        Maximal size of the cache. Default value: 10.
+    """
+
+    def __init__(self, folder=None, max_size_gb=10.0):
+        if folder is None:
+            folder = os.environ.get("CARL_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "carl-torch"))
+        self.folder = folder
+        self.max_size_gb = max_size_gb
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    @staticmethod
+    def key(model_checksum, data, backend="torch"):
+        return hashlib.sha256("{}|{}|{}".format(model_checksum, data, backend).encode("utf-8")).hexdigest()
+
+    def _filename(self, key, output):
+        return os.path.join(self.folder, "{}_{}.npy".format(key, output))
+
+    def get(self, key):
+        """ Returns the cached (r_hat, s_hat, r_hat_std) memory maps, or None """
+        filenames = [self._filename(key, output) for output in OUTPUTS]
+        if not all(os.path.isfile(filename) for filename in filenames):
+            return None
+        try:
+            results = tuple(np.load(filename, mmap_mode="r") for filename in filenames)
+        except (IOError, ValueError):
+            logger.warning("Removing corrupt cache entry %s", key)
+            self._remove(key)
+            return None
+
+        # Mark as recently used
+        now = time.time()
+        for filename in filenames:
+            os.utime(filename, (now, now))
+        logger.debug("Evaluation found in cache %s", key)
+        return results
+
+    def put(self, key, *results):
+        for output, result in zip(OUTPUTS, results):
+            # Written under a temporary name first, so that concurrent readers never see partial files
+            tmp_filename = self._filename(key, output) + ".tmp.npy"
+            np.save(tmp_filename, result)
+            os.replace(tmp_filename, self._filename(key, output))
+        self.evict()
+
+    def _remove(self, key):
+        for output in OUTPUTS:
+            try:
+                os.remove(self._filename(key, output))
+            except OSError:
+                pass
+
+    def entries(self):
+        """ Returns a dict of key: (size in bytes, last use time) """
+        entries = {}
+        for filename in os.listdir(self.folder):
+            if not filename.endswith(".npy") or filename.endswith(".tmp.npy"):
+                continue
+            key = filename.split("_", 1)[0]
+            status = os.stat(os.path.join(self.folder, filename))
+            size, last_used = entries.get(key, (0, 0.0))
+            entries[key] = (size + status.st_size, max(last_used, status.st_mtime))
+        return entries
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache is smaller than max_size_gb """
+        entries = self.entries()
+        size = sum(entry_size for entry_size, _ in entries.values())
+        max_size = self.max_size_gb * 1024 ** 3
+        for key, (entry_size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+            if size <= max_size:
+                break
+            logger.debug("Evicting cache entry %s", key)
+            self._remove(key)
+            size -= entry_size
+
+    def clear(self):
+        for key in self.entries():
+            self._remove(key)
@@ -15,7 +15,7 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from functools import partial
 from collections import defaultdict
-from .tools import create_missing_folders, load, load_and_check, HarmonisedLoading
+from .tools import create_missing_folders, load, load_and_check, HarmonisedLoading, unweight
 from .plotting import draw_weighted_distributions, draw_unweighted_distributions, draw_ROC, resampled_discriminator_and_roc, plot_calibration_curve, draw_weights, draw_scatter
 from sklearn.model_selection import train_test_split
 logger = logging.getLogger(__name__)
@@ -45,6 +45,8 @@ class Loader():
         nentries = 0,
         pathA = '',
         pathB = '',
+        unweighting = False,
+        max_weight_quantile = 0.99,
     ):
         """
         Parameters
@@ -68,6 +70,13 @@ class Loader():
         save : bool, optional
             Save training ans test samples. Default value:
             False
+        unweighting : bool, optional
+            Partially unweight both samples by acceptance-rejection before the train / validation split, see
+            `tools.unweight`. Gives a smaller dataset with bounded weights. Default value:
+            False
+        max_weight_quantile : float, optional
+            Quantile of |w| used as maximum weight in the unweighting, 1 means full unweighting. Default value:
+            0.99
         Returns
         -------
         x : ndarray
@@ -182,13 +191,21 @@ class Loader():
         # Convert weights to numpy
         w0 = w0.to_numpy()
         w1 = w1.to_numpy()
+
+        # Compress the weighted samples into fewer events with bounded weights
+        if unweighting:
+            logger.info(" Unweighting x0")
+            X0, w0 = unweight(X0, w0, max_weight_quantile=max_weight_quantile)
+            logger.info(" Unweighting x1")
+            X1, w1 = unweight(X1, w1, max_weight_quantile=max_weight_quantile)
+
         # Temporary  -#sjiggins
         w0 = (w0 *10000) / (w0.sum())
         w1 = (w1 *10000) / (w1.sum())
         
         # combine
-        y0 = np.zeros(x0.shape[0])
-        y1 = np.ones(x1.shape[0])
+        y0 = np.zeros(X0.shape[0])
+        y1 = np.ones(X1.shape[0])
         
         X0_train, X0_test, y0_train, y0_test, w0_train, w0_test = train_test_split(X0, y0, w0, test_size=0.40, random_state=42)
         X1_train, X1_test, y1_train, y1_test, w1_train, w1_test = train_test_split(X1, y1, w1, test_size=0.40, random_state=42)
@@ -100,6 +100,36 @@ def CoherentFlattening(df0, df1):
     #print(df)
     return df0,df1
 
+def flatten_arrays(arrays, observables, dtype=np.float32):
+    """
+    Flattens a chunk of TTree branches (as returned by uproot with library="np") into a matrix with one column per
+    observable, in the same way as `CoherentFlattening`: the element `idx` of a jagged branch `name` is the observable
+    `name + str(idx)`, zero-padded for shorter events.
+    """
+    n_events = len(next(iter(arrays.values())))
+    x = np.zeros((n_events, len(observables)), dtype=dtype)
+    jagged = {}
+    for i, observable in enumerate(observables):
+        if observable in arrays:
+            x[:, i] = arrays[observable]
+            continue
+
+        # Element idx of a jagged branch
+        branches = [name for name in arrays if observable.startswith(name) and observable[len(name):].isdigit()]
+        if not branches:
+            raise RuntimeError("Observable {} not found in branches {}".format(observable, list(arrays.keys())))
+        branch = max(branches, key=len)
+        idx = int(observable[len(branch):])
+        if branch not in jagged:
+            lengths = np.array([len(event) for event in arrays[branch]], dtype=np.int64)
+            values = np.concatenate(list(arrays[branch])) if n_events > 0 else np.zeros(0)
+            jagged[branch] = (lengths, np.cumsum(lengths) - lengths, values)
+        lengths, starts, values = jagged[branch]
+        filled = lengths > idx
+        x[filled, i] = values[starts[filled] + idx]
+    return x
+
+
 def load(
     f="",
     features=[],
@@ -142,6 +172,68 @@ def load(
     return (df, weights, labels)
 
 
+def effective_sample_size(w):
+    """ Kish effective sample size (sum w)^2 / sum w^2 """
+    w = np.asarray(w, dtype=np.float64).reshape(-1)
+    sum_w2 = np.sum(w ** 2)
+    return np.sum(w) ** 2 / sum_w2 if sum_w2 > 0 else 0.0
+
+
+def unweight(x, w, max_weight_quantile=0.99, chunk_size=1000000, random_state=42):
+    """
+    Partial unweighting by acceptance-rejection. Events are kept with probability min(1, |w| / w_max), where w_max
+    is the `max_weight_quantile` quantile of |w|, and the kept events get the weight sign(w) * max(|w|, w_max). This
+    keeps the expected weighted distributions, bounds the weight spread from below and drops most of the events with
+    tiny weights. With `max_weight_quantile=1` the sample is fully unweighted (all weights equal to +-w_max).
+    The acceptance is evaluated vectorized, chunk by chunk.
+    Parameters
+    ----------
+    x : ndarray
+        Observables with shape `(n_samples, n_observables)`.
+    w : ndarray
+        Event weights with shape `(n_samples,)` or `(n_samples, 1)`.
+    Returns
+    -------
+    x : ndarray
+        Kept observables.
+    w : ndarray
+        Weights of the kept events, with the same shape convention as the input.
+    """
+    rng = np.random.RandomState(random_state)
+    shape = w.shape
+    w = np.asarray(w).reshape(-1)
+    w_max = np.quantile(np.abs(w), max_weight_quantile)
+
+    x_kept, w_kept = [], []
+    for start in range(0, len(w), chunk_size):
+        w_chunk = w[start : start + chunk_size]
+        abs_w = np.abs(w_chunk)
+        accepted = rng.uniform(size=len(w_chunk)) * w_max < abs_w
+        x_kept.append(x[start : start + chunk_size][accepted])
+        w_kept.append(np.sign(w_chunk[accepted]) * np.maximum(abs_w[accepted], w_max))
+
+    x_kept = np.concatenate(x_kept) if x_kept else x[:0]
+    w_kept = np.concatenate(w_kept) if w_kept else w[:0]
+    logger.info(
+        "  Unweighting with w_max = %s (%s quantile of |w|): kept %s of %s events, effective sample size %.1f -> %.1f",
+        w_max,
+        max_weight_quantile,
+        len(w_kept),
+        len(w),
+        effective_sample_size(w),
+        effective_sample_size(w_kept),
+    )
+    return x_kept, w_kept.reshape((-1,) + tuple(shape[1:]))
+
+
+def available_cpus():
+    """ Number of CPUs this process may run on, honouring the CPU affinity mask of batch jobs """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
 def create_missing_folders(folders):
     if folders is None:
         return
@@ -157,7 +249,12 @@ def create_missing_folders(folders):
             raise OSError("Path {} exists, but is no directory!".format(folder))
 
 
-def load_and_check(filename, warning_threshold=1.0e9, memmap_files_larger_than_gb=None):
+def load_and_check(filename, warning_threshold=1.0e9, memmap_files_larger_than_gb=None, check=True):
+    """
+    Loads an array from a .npy file (optionally as memory map) or passes an array through, reshaping 1D input to a
+    column. Unless the data is memory mapped or `check` is False, it is scanned for NaNs, Infs and numbers larger than
+    `warning_threshold`, which reads the whole input and allocates temporaries of its size.
+    """
     if filename is None:
         return None
 
@@ -165,7 +262,7 @@ def load_and_check(filename, warning_threshold=1.0e9, memmap_files_larger_than_g
         data = filename
         memmap = False
     else:
-        filesize_gb = os.stat(filename).st_size / 1.0 * 1024 ** 3
+        filesize_gb = os.stat(filename).st_size / (1.0 * 1024 ** 3)
         if memmap_files_larger_than_gb is None or filesize_gb <= memmap_files_larger_than_gb:
             logger.info("  Loading %s into RAM", filename)
             data = np.load(filename)
@@ -175,7 +272,7 @@ def load_and_check(filename, warning_threshold=1.0e9, memmap_files_larger_than_g
             data = np.load(filename, mmap_mode="c")
             memmap = True
 
-    if not memmap:
+    if check and not memmap:
         n_nans = np.sum(np.isnan(data))
         n_infs = np.sum(np.isinf(data))
         n_finite = np.sum(np.isfinite(data))
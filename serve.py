@@ -0,0 +1,29 @@
+import logging
+import optparse
+from ml.server import InferenceServer
+
+#################################################
+# Arugment parsing
+parser = optparse.OptionParser(usage="usage: %prog [opts]", version="%prog 1.0")
+parser.add_option('-m', '--models',   action='store', type=str, dest='models',   default='', help='Comma separated list of name=path of saved models, e.g. QSFUP=models/QSFUP_carl_1000')
+parser.add_option('-a', '--address',  action='store', type=str, dest='address',  default='/tmp/carl.sock', help='Path of the Unix socket, or tcp:host:port for localhost TCP')
+parser.add_option('--max_batch_size',  action='store', type=int, dest='max_batch_size',  default=65536, help='Maximal number of events evaluated together')
+parser.add_option('--max_latency_ms',  action='store', type=float, dest='max_latency_ms',  default=5., help='Maximal time in ms a request waits to be batched with others')
+parser.add_option('--backend',  action='store', type=str, dest='backend',  default='torch', help='Inference backend, torch or onnxruntime')
+parser.add_option('--threads',  action='store', type=int, dest='threads',  default=None, help='Intra-op threads of the onnxruntime sessions')
+(opts, args) = parser.parse_args()
+#################################################
+
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    models = dict(model.split("=", 1) if "=" in model else (model, model) for model in opts.models.split(","))
+    server = InferenceServer(
+        models,
+        address=opts.address,
+        max_batch_size=opts.max_batch_size,
+        max_latency=opts.max_latency_ms / 1000.,
+        backend=opts.backend,
+        n_threads=opts.threads,
+    )
+    server.serve_forever()
@@ -0,0 +1,263 @@
+import threading
+import json
+import numpy as np
+import torch
+import onnx
+import onnxruntime as ort
+import uproot
+from ml.models import RatioModel, EnsembleRatioModel
+from ml.evaluate import evaluate_ratio_model
+from ml.ratio import RatioEstimator
+from ml.utils.tools import flatten_arrays
+from ml.server import InferenceServer, InferenceClient
+from ml.inference import batch_evaluate, apply_to_root, make_shards, parallel_evaluate, load_sharded_output
+from ml.utils.cache import EvaluationCache
+from ml.calibration import CalibratedClassifier, HistogramCalibrator, StreamingHistogramCalibrator
+
+def untrained_estimator(n_hidden=(10,10), x=None):
+    """ Estimator with a randomly initialised network for the test sample, with the input scaling of x if given """
+    estimator = RatioEstimator(n_hidden=n_hidden, activation="relu")
+    estimator.n_observables = np.load('tests/data/dilepton/QSFUP/X_train_10.npy').shape[1]
+    estimator._create_model()
+    if x is not None:
+        estimator.initialize_input_transform(x)
+    estimator._set_model_input_scaling()
+    return estimator
+
+def test_chunked_evaluation():
+    x = np.load('tests/data/dilepton/QSFUP/X_train_10.npy')
+    model = RatioModel(n_observables=x.shape[1], n_hidden=(10,10), activation="relu")
+
+    r_hat, s_hat = evaluate_ratio_model(model, x, chunk_size=len(x))
+    r_chunked, s_chunked = evaluate_ratio_model(model, x, chunk_size=3)
+    assert r_hat.shape == s_hat.shape == (len(x),)
+    assert np.allclose(r_hat, r_chunked)
+    assert np.allclose(s_hat, s_chunked)
+    assert np.allclose(r_hat, (1. - s_hat) / s_hat, rtol=1.e-4)
+
+def test_chunked_ensemble_evaluation():
+    x = np.load('tests/data/dilepton/QSFUP/X_train_10.npy')
+    model = EnsembleRatioModel(n_members=3, n_observables=2, n_hidden=(10,), activation="relu")
+
+    r_hat, s_hat = evaluate_ratio_model(model, x, chunk_size=4, features=[0, 1])
+    assert r_hat.shape == s_hat.shape == (3, len(x))
+
+def test_onnxruntime_backend():
+    x = np.load('tests/data/dilepton/QSFUP/X_train_10.npy')
+    estimator = untrained_estimator()
+
+    r_torch, s_torch = estimator.evaluate_ratio(x)
+    r_onnx, s_onnx = estimator.evaluate_ratio(x, backend="onnxruntime", n_threads=1, chunk_size=3)
+    assert estimator.onnx_session(n_threads=1) is estimator.onnx_session(n_threads=1)
+    assert np.allclose(s_onnx, s_torch, atol=1.e-5)
+    assert np.allclose(r_onnx, r_torch, rtol=1.e-4)
+
+def test_onnx_export(tmpdir):
+    x = np.load('tests/data/dilepton/QSFUP/X_train_10.npy').astype(np.float32)
+    estimator = untrained_estimator(x=x)
+    metaData = {"x{}".format(i): i for i in range(x.shape[1])}
+    filename = str(tmpdir.join("model.onnx"))
+    estimator.export_onnx(filename, metaData)
+
+    model = onnx.load(filename)
+    assert model.graph.input[0].type.tensor_type.shape.dim[0].dim_param == "batch"
+    metadata = {meta.key: meta.value for meta in model.metadata_props}
+    assert json.loads(metadata["observables"]) == list(metaData.keys())
+    assert metadata["scaling"] == "minmax"
+    assert len(json.loads(metadata["scaling_shift"])) == x.shape[1]
+
+    session = ort.InferenceSession(filename)
+    for n_events in [1, 7]:
+        r_hat, s_hat = session.run(None, {"input": x[:n_events]})
+        assert s_hat.shape[0] == n_events
+        assert np.allclose(s_hat.flatten(), estimator.evaluate_ratio(x[:n_events])[1], atol=1.e-5)
+
+def test_dynamic_quantization():
+    x = np.load('tests/data/dilepton/QSFUP/X_train_10.npy')
+    estimator = untrained_estimator()
+
+    report = estimator.quantize(x, force=True)
+    assert estimator.quantized
+    assert set(report) == {"mean_relative_deviation", "max_relative_deviation", "sum_shift", "quantile_shift", "within_tolerance"}
+    r_hat, s_hat = estimator.evaluate_ratio(x)
+    assert r_hat.shape == s_hat.shape == (len(x),)
+
+def test_bundle_roundtrip(tmpdir):
+    x = np.load('tests/data/dilepton/QSFUP/X_train_10.npy')
+    estimator = untrained_estimator(x=x)
+    filename = str(tmpdir.join("model"))
+    estimator.save(filename)
+
+    loaded = RatioEstimator()
+    loaded.load(filename)
+    loaded_again = RatioEstimator()
+    loaded_again.load(filename)
+    assert np.allclose(loaded.evaluate_ratio(x)[1], estimator.evaluate_ratio(x)[1])
+    assert np.allclose(loaded_again.x_scaling_maxs, estimator.x_scaling_maxs)
+
+def test_flatten_arrays():
+    jets = np.empty(3, dtype=object)
+    jets[:] = [np.array([3., 2., 1.]), np.array([5.]), np.array([])]
+    arrays = {"met": np.array([10., 20., 30.]), "jet_pt": jets}
+
+    x = flatten_arrays(arrays, ["jet_pt0", "jet_pt1", "met"])
+    assert np.allclose(x, [[3., 2., 10.], [5., 0., 20.], [0., 0., 30.]])
+
+def test_apply_to_root(tmpdir):
+    x = np.load('tests/data/dilepton/QSFUP/X_train_10.npy').astype(np.float32)
+    observables = ["x{}".format(i) for i in range(x.shape[1])]
+    estimator = untrained_estimator(n_hidden=(10,))
+    estimator.observables = observables
+
+    input_file, output_file = str(tmpdir.join("input.root")), str(tmpdir.join("output.root"))
+    with uproot.recreate(input_file) as f:
+        f["Tree"] = {name: x[:, i] for i, name in enumerate(observables)}
+
+    n_events = apply_to_root(estimator, input_file, output_file, "Tree", step_size=4, write_s_hat=True)
+    arrays = uproot.open(output_file)["Tree"].arrays(["w_carl", "s_hat"], library="np")
+    r_hat, s_hat = estimator.evaluate_ratio(x)
+    assert n_events == len(x)
+    assert np.allclose(arrays["w_carl"], 1. / r_hat, rtol=1.e-5)
+    assert np.allclose(arrays["s_hat"], s_hat, atol=1.e-6)
+
+def test_parallel_evaluation(tmpdir):
+    x = 'tests/data/dilepton/QSFUP/X_train_10.npy'
+    estimator = untrained_estimator(n_hidden=(10,))
+    model_filename = str(tmpdir.join("model"))
+    estimator.save(model_filename)
+
+    shards = make_shards([x], shard_size=4)
+    assert shards[0] == (x, 0, 4)
+    assert shards[-1][2] == len(np.load(x))
+
+    output_dir = str(tmpdir.join("output"))
+    manifest = parallel_evaluate(model_filename, [x], output_dir, n_processes=1, chunk_size=3, shard_size=4)
+    assert len(manifest["shards"]) == len(shards)
+    r_hat = load_sharded_output(output_dir, "r_hat")[x]
+    s_hat = load_sharded_output(output_dir, "s_hat")[x]
+    r_expected, s_expected = estimator.evaluate_ratio(x)
+    assert np.allclose(r_hat, r_expected, rtol=1.e-5)
+    assert np.allclose(s_hat, s_expected, atol=1.e-6)
+
+    # By default the events are spread over the processes
+    manifest = parallel_evaluate(model_filename, [x], str(tmpdir.join("default")), n_processes=2)
+    assert len(manifest["shards"]) == 2
+
+def test_inference_server(tmpdir):
+    x = np.load('tests/data/dilepton/QSFUP/X_train_10.npy')
+    estimator = untrained_estimator()
+
+    server = InferenceServer({"test": estimator}, address=str(tmpdir.join("carl.sock")), max_latency=0.001)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with InferenceClient(address=str(tmpdir.join("carl.sock"))) as client:
+            r_hat, s_hat = client.evaluate(x)
+            assert client.models() == ["test"]
+            assert client.metrics()["events"] == len(x)
+            # A request with the wrong number of observables fails without affecting the next one
+            try:
+                client.evaluate(x[:, :-1])
+                assert False
+            except RuntimeError:
+                pass
+            assert np.allclose(client.evaluate(x)[1], s_hat)
+    finally:
+        server.shutdown()
+        thread.join()
+    assert np.allclose(s_hat, estimator.evaluate_ratio(x)[1], atol=1.e-6)
+
+def test_batch_evaluation(tmpdir):
+    x = 'tests/data/dilepton/QSFUP/X_train_10.npy'
+    models = {}
+    for name in ["a", "b"]:
+        models[name] = untrained_estimator(n_hidden=(10,))
+
+    description = batch_evaluate(models, {"train": x}, str(tmpdir), chunk_size=4)
+    weights = np.load(str(tmpdir.join(description["samples"]["train"]["weights"])))
+    assert description["columns"] == ["a", "b"]
+    assert np.allclose(weights[:, 1], 1. / models["b"].evaluate_ratio(x)[0], rtol=1.e-5)
+
+def test_evaluation_cache(tmpdir):
+    x = 'tests/data/dilepton/QSFUP/X_train_10.npy'
+    estimator = untrained_estimator(n_hidden=(10,))
+    cache = EvaluationCache(str(tmpdir))
+
+    r_hat, s_hat = estimator.evaluate_ratio(x, cache=cache)
+    assert len(cache.entries()) == 1
+    r_cached, s_cached = estimator.evaluate_ratio(x, cache=cache)
+    assert isinstance(r_cached, np.memmap)
+    assert np.allclose(r_cached, r_hat)
+
+    cache.max_size_gb = 0.
+    cache.evict()
+    assert len(cache.entries()) == 0
+
+def test_calibration_with_scores():
+    rng = np.random.RandomState(0)
+    y = np.concatenate([np.zeros(500), np.ones(500)])
+    T = np.clip(0.5 + 0.2 * (y - 0.5) + 0.1 * rng.randn(1000), 0., 1.)
+
+    calib = CalibratedClassifier(None, bins=20)
+    p0, p1, r = calib.fit_predict(y=y, T=T)
+    p0_chunked, p1_chunked, r_chunked = calib.predict(T=T, chunk_size=7)
+    assert np.allclose(p1, p1_chunked) and np.allclose(r, r_chunked)
+    assert np.allclose(p1, calib.predict_proba(None, T)[:, 1])
+    # Bins with a single class give p1 = 0 or 1, which predict replaces by 1 in both outputs
+    mixed = (p1 > 0) & (p1 < 1)
+    assert np.allclose(p0[mixed] + p1[mixed], 1.)
+
+def test_calibration_lookup_table():
+    rng = np.random.RandomState(1)
+    y = np.concatenate([np.zeros(2000), np.ones(2000)])
+    T = np.clip(0.5 + 0.2 * (y - 0.5) + 0.1 * rng.randn(4000), 0., 1.)
+    T_test = np.concatenate([rng.uniform(-0.2, 1.2, 10000), [T.min(), T.max()]])
+
+    for variable_width in [False, True]:
+        calibrator = HistogramCalibrator(bins=30, variable_width=variable_width).fit(T, y)
+        assert calibrator.table_ is not None
+        assert np.allclose(calibrator.predict(T_test), calibrator._ratio(T_test))
+
+def test_streaming_calibration():
+    rng = np.random.RandomState(2)
+    y = np.concatenate([np.zeros(3000), np.ones(3000)])
+    T = np.clip(0.5 + 0.2 * (y - 0.5) + 0.1 * rng.randn(6000), 0., 1.)
+    order = rng.permutation(6000)
+    T, y = T[order], y[order]
+
+    full = StreamingHistogramCalibrator(bins=25).partial_fit(T, y)
+    parts = [StreamingHistogramCalibrator(bins=25).partial_fit(T[i::3], y[i::3]) for i in range(3)]
+    merged = parts[0].merge(parts[1]).merge(parts[2])
+    assert np.allclose(merged.counts_, full.counts_)
+
+    reference = HistogramCalibrator(bins=25, range=[(0., 1.)]).fit(T, y)
+    assert np.allclose(merged.to_histogram_calibrator().predict(T), reference.predict(T))
+
+def test_streaming_calibration_of_model(tmpdir):
+    x = 'tests/data/dilepton/QSFUP/X_train_10.npy'
+    y = 'tests/data/dilepton/QSFUP/y_train_10.npy'
+    estimator = untrained_estimator(n_hidden=(10,))
+    estimator.evaluation_cache = EvaluationCache(str(tmpdir))
+
+    calib = CalibratedClassifier(estimator, bins=10).fit_streaming(x, y, chunk_size=2)
+    assert len(estimator.evaluation_cache.entries()) == 0
+
+    _, s_hat = estimator.evaluate_ratio(x, cache=False)
+    reference = HistogramCalibrator(bins=10, range=[(0., 1.)]).fit(s_hat, np.load(y))
+    assert np.allclose(calib.calibrator.predict(s_hat), reference.predict(s_hat))
+
+def test_calibration_in_bundle(tmpdir):
+    rng = np.random.RandomState(3)
+    x = rng.normal(size=(1000, np.load('tests/data/dilepton/QSFUP/X_train_10.npy').shape[1]))
+    y = rng.randint(2, size=1000)
+    estimator = untrained_estimator(x=x)
+    calib = CalibratedClassifier(estimator, bins=20).fit(X=x, y=y)
+    p0, p1, r = calib.predict(X=x)
+
+    filename = str(tmpdir.join("model"))
+    estimator.save(filename, calibrator=calib)
+    loaded = RatioEstimator()
+    loaded.load(filename)
+    restored = CalibratedClassifier.from_model(loaded)
+    p0_restored, p1_restored, r_restored = restored.predict(X=x)
+    assert np.allclose(p1_restored, p1) and np.allclose(r_restored, r)
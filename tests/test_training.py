@@ -1,9 +1,20 @@
 import os
 import sys
+import json
 import logging
 import optparse
 import tarfile
+import numpy as np
+import pytest
+import torch
+from torch import nn
+from collections import OrderedDict
 from ml import RatioEstimator
+from ml.models import RatioModel
+from ml.utils.tools import unweight, available_cpus
+from torch.utils.data import DataLoader
+from ml.trainers import RatioTrainer, NumpyDataset, BatchPrefetcher, BalancedEpochSampler, ProgressiveSampler
+from ml.functions import get_loss
 
 def test_training():
     x ='tests/data/dilepton/QSFUP/X_train_10.npy'
@@ -26,6 +37,234 @@ def test_training():
         x1=x1,
         scale_inputs = True,
     )
+
+def test_ensemble_training():
+    x ='tests/data/dilepton/QSFUP/X_train_10.npy'
+    y ='tests/data/dilepton/QSFUP/y_train_10.npy'
+    w = np.ones(len(np.load(y)))
+
+    estimator = RatioEstimator(
+        n_hidden=(10,10),
+        activation="relu",
+        n_ensemble=3,
+    )
+    estimator.train(
+        method='carl',
+        batch_size = 1024,
+        n_epochs = 1,
+        x=x,
+        y=y,
+        w=w,
+        scale_inputs = True,
+    )
+    r_hat, s_hat, r_hat_std = estimator.evaluate(x, return_std=True)
+    assert r_hat.shape == s_hat.shape == r_hat_std.shape == (len(w),)
+    assert np.all(r_hat_std > 0.)
+
+def test_gradient_accumulation():
+    x = np.load('tests/data/dilepton/QSFUP/X_train_10.npy')
+    y = np.load('tests/data/dilepton/QSFUP/y_train_10.npy').reshape(-1, 1)
+    w = np.random.uniform(0.5, 2., size=y.shape)
+    batch_data = OrderedDict([
+        ("x", torch.from_numpy(x).float()),
+        ("y", torch.from_numpy(y).float()),
+        ("w", torch.from_numpy(w).float()),
+    ])
+    loss_functions, _, loss_weights = get_loss("carl", 1.0)
+
+    # Without dropout both passes see the same network
+    model = RatioModel(n_observables=x.shape[1], n_hidden=(10,10), activation="relu", dropout_prob=0.0)
+    trainer = RatioTrainer(model, run_on_gpu=False)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.)
+
+    loss_full, _ = trainer.batch_train(batch_data, loss_functions, loss_weights, optimizer)
+    grads_full = [p.grad.clone() for p in model.parameters()]
+    loss_micro, _ = trainer.batch_train(batch_data, loss_functions, loss_weights, optimizer, micro_batch_size=3)
+    grads_micro = [p.grad.clone() for p in model.parameters()]
+
+    assert np.isclose(loss_full, loss_micro, rtol=1.e-5)
+    for g_full, g_micro in zip(grads_full, grads_micro):
+        assert torch.allclose(g_full, g_micro, rtol=1.e-4, atol=1.e-6)
+
+def test_batch_prefetcher():
+    x = np.load('tests/data/dilepton/QSFUP/X_train_10.npy')
+    dataset = NumpyDataset(x, np.arange(len(x), dtype=np.float64))
+    loader = DataLoader(dataset, batch_size=4, shuffle=False)
+    prefetcher = BatchPrefetcher(loader, torch.device("cpu"), torch.float)
+
+    assert len(prefetcher) == len(loader)
+    for (x_ref, i_ref), (x_pre, i_pre) in zip(loader, prefetcher):
+        assert torch.equal(x_ref, x_pre)
+        assert torch.equal(i_ref, i_pre)
+
+def test_input_scaling_layer():
+    x = np.load('tests/data/dilepton/QSFUP/X_train_10.npy')
+    estimator = RatioEstimator(n_hidden=(10,10), activation="relu")
+    estimator.n_observables = x.shape[1]
+    estimator.initialize_input_transform(x)
+    estimator._create_model()
+    estimator._set_model_input_scaling()
+
+    scaled = torch.from_numpy(estimator._transform_inputs(x)).float()
+    assert torch.allclose(estimator.model.input_scaling(torch.from_numpy(x).float()), scaled, atol=1.e-5)
+
+def test_balanced_epoch_sampler():
+    labels = np.concatenate((np.zeros(2000), np.ones(100)))
+    weights = np.random.exponential(size=len(labels))
+    sampler = BalancedEpochSampler(np.arange(len(labels)), labels, weights, ratio=2.)
+    assert len(sampler) == 300
+
+    # The compensated weights reproduce the weight sum of the full sample, scaled by the epoch fraction
+    sums = []
+    for _ in range(200):
+        idx = np.array(list(sampler))
+        batch_data = OrderedDict([
+            ("y", torch.from_numpy(labels[idx]).view(-1, 1)),
+            ("w", torch.from_numpy(weights[idx]).view(-1, 1)),
+        ])
+        sums.append(sampler.reweight(batch_data)["w"].sum().item())
+    assert np.isclose(np.mean(sums), sampler.norm * weights.sum(), rtol=0.05)
+
+def test_progressive_sampler():
+    sampler = ProgressiveSampler(np.arange(1000), fractions=(0.1, 0.3, 1.0), start_epochs=(0, 2, 5))
+    subsets = []
+    for i_epoch in range(6):
+        sampler.set_epoch(i_epoch)
+        subsets.append(set(sampler))
+    assert [len(subset) for subset in subsets] == [100, 100, 300, 300, 300, 1000]
+    assert subsets[0] <= subsets[2] <= subsets[5]
+
+def test_distillation():
+    x ='tests/data/dilepton/QSFUP/X_train_10.npy'
+    y ='tests/data/dilepton/QSFUP/y_train_10.npy'
+    x0='tests/data/dilepton/QSFUP/X0_train_10.npy'
+
+    teacher = RatioEstimator(n_hidden=(20,20), activation="relu", n_ensemble=2)
+    teacher.train(method='carl', batch_size=1024, n_epochs=1, x=x, y=y, w=np.ones(len(np.load(y))), scale_inputs=True)
+
+    student = RatioEstimator(n_hidden=(5,), activation="relu")
+    report = student.distill(teacher, x=x, y=y, x_unlabeled=x0, batch_size=1024, n_epochs=1)
+    assert set(report) == {"teacher", "student"}
+    assert isinstance(student.model, RatioModel)
+
+    # The same with arrays instead of file names
+    student = RatioEstimator(n_hidden=(5,), activation="relu")
+    report = student.distill(teacher, x=np.load(x), y=np.load(y), x_unlabeled=np.load(x0), batch_size=1024, n_epochs=1)
+    assert set(report["student"]) == {"auc", "closure", "seconds_per_event"}
+
+def test_unweight():
+    rng = np.random.RandomState(0)
+    x = rng.normal(size=(100000, 2))
+    w = rng.exponential(size=(100000, 1)) * np.where(rng.uniform(size=(100000, 1)) < 0.1, -1., 1.)
+    w_max = np.quantile(np.abs(w), 0.99)
+
+    x_kept, w_kept = unweight(x, w, max_weight_quantile=0.99, chunk_size=30000, random_state=1)
+    assert w_kept.shape == (len(x_kept), 1)
+    assert len(x_kept) < len(x)
+    # Kept weights are raised to at least w_max, events above it are kept unchanged
+    assert np.all(np.abs(w_kept) >= w_max * (1. - 1.e-12))
+    assert np.sum(np.abs(w) > w_max) == np.sum(np.abs(w_kept) > w_max)
+    # The expected yield is preserved
+    assert np.isclose(np.sum(w_kept), np.sum(w), rtol=0.03)
+
+    x_again, w_again = unweight(x, w, max_weight_quantile=0.99, random_state=1)
+    assert np.array_equal(x_again, x_kept) and np.array_equal(w_again, w_kept)
+    _, w_other = unweight(x, w, max_weight_quantile=0.99, random_state=2)
+    assert len(w_other) != len(w_kept) or not np.array_equal(w_other, w_kept)
+
+def test_fine_tuning(tmpdir, monkeypatch):
+    x ='tests/data/dilepton/QSFUP/X_train_10.npy'
+    y ='tests/data/dilepton/QSFUP/y_train_10.npy'
+    w = np.ones(len(np.load(y)))
+    kwargs = dict(method='carl', batch_size=1024, n_epochs=1, x=x, y=y, w=w, scale_inputs=True)
+
+    source = RatioEstimator(n_hidden=(10,10), activation="relu")
+    source.train(**kwargs)
+    filename = str(tmpdir.join("source"))
+    source.save(filename)
+
+    # Incompatible architecture or features
+    with pytest.raises(RuntimeError):
+        RatioEstimator(n_hidden=(5,), activation="relu").train(init_from=filename, **kwargs)
+    with pytest.raises(RuntimeError):
+        RatioEstimator(n_hidden=(10,10), activation="relu", features=[0, 1]).train(init_from=filename, **kwargs)
+
+    # The frozen first layer keeps its weights, all layers are trainable again afterwards
+    estimator = RatioEstimator(n_hidden=(10,10), activation="relu")
+    estimator.train(init_from=filename, freeze_layers=1, initial_lr=0.1, final_lr=0.1, **kwargs)
+    linear_layers = [layer for layer in estimator.model.layers if isinstance(layer, nn.Linear)]
+    source_layers = [layer for layer in source.model.layers if isinstance(layer, nn.Linear)]
+    assert torch.equal(linear_layers[0].weight, source_layers[0].weight)
+    assert all(parameter.requires_grad for parameter in estimator.model.parameters())
+
+    # Also when the training fails
+    def failing_train(*args, **kwargs):
+        assert not any(parameter.requires_grad for parameter in estimator.model.layers[0].parameters())
+        raise RuntimeError("Training failed")
+
+    monkeypatch.setattr(RatioTrainer, "train", failing_train)
+    estimator = RatioEstimator(n_hidden=(10,10), activation="relu")
+    with pytest.raises(RuntimeError, match="Training failed"):
+        estimator.train(init_from=filename, freeze_layers=1, **kwargs)
+    assert all(parameter.requires_grad for parameter in estimator.model.parameters())
+
+def test_autotune_profile(tmpdir):
+    rng = np.random.RandomState(0)
+    x = rng.normal(size=(2000, 8))
+    y = rng.randint(2, size=(2000, 1)).astype(np.float64)
+    dataset = NumpyDataset(x, y, np.ones((2000, 1)))
+    loss_functions, _, loss_weights = get_loss("carl", 1.0)
+    trainer = RatioTrainer(RatioModel(n_observables=8, n_hidden=(10,), activation="relu"), run_on_gpu=False)
+    profile = str(tmpdir.join("autotune.json"))
+
+    def autotune():
+        return trainer.autotune(
+            dataset, ["x", "y", "w"], loss_functions, loss_weights, batch_sizes=[100],
+            n_workers_candidates=[0], n_threads_candidates=[1], n_batches=3, profile=profile,
+        )
+
+    assert autotune() == 100
+    with open(profile, "r") as f:
+        config = json.load(f)
+    assert config["n_cpus"] == available_cpus()
+
+    # A profile for the same number of CPUs is reused without benchmarking
+    with open(profile, "w") as f:
+        json.dump(dict(config, batch_size=37), f)
+    assert autotune() == 37
+
+    # One made for another number of CPUs is replaced
+    with open(profile, "w") as f:
+        json.dump(dict(config, batch_size=37, n_cpus=config["n_cpus"] + 1), f)
+    assert autotune() == 100
+    with open(profile, "r") as f:
+        assert json.load(f)["n_cpus"] == available_cpus()
+
+def test_sparse_validation():
+    rng = np.random.RandomState(0)
+    data = OrderedDict([
+        ("x", rng.normal(size=(1000, 8))),
+        ("y", rng.randint(2, size=(1000, 1)).astype(np.float64)),
+        ("w", np.ones((1000, 1))),
+    ])
+    loss_functions, loss_labels, loss_weights = get_loss("carl", 1.0)
+    trainer = RatioTrainer(RatioModel(n_observables=8, n_hidden=(10,), dropout_prob=0.0), run_on_gpu=False)
+
+    # The validation subsample is drawn once and read in the same order every epoch
+    train_loader, val_loader = trainer.make_dataloaders(trainer.make_dataset(data)[1], None, 0.25, 100, 50)
+    valid_idx = list(val_loader.sampler)
+    assert len(valid_idx) == 50 and valid_idx == sorted(valid_idx) == list(val_loader.sampler)
+    assert not set(valid_idx) & set(train_loader.sampler.indices)
+
+    # With a vanishing learning rate the validation loss never improves: the first validation is the best one, and
+    # the patience of one epoch runs out at the next validation
+    losses_train, losses_val = trainer.train(
+        data, loss_functions, loss_weights, loss_labels, epochs=10, batch_size=100, optimizer=torch.optim.SGD,
+        initial_lr=1.e-30, final_lr=1.e-30, validate_every=2, n_validation_samples=50, early_stopping_patience=1,
+    )
+    assert len(losses_train) == 4
+    assert list(np.isnan(losses_val)) == [True, False, True, False]
+
 if __name__ == "__main__":
     test_training()
     assert True
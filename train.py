@@ -20,6 +20,12 @@ parser.add_option('-g', '--global_name',  action='store', type=str, dest='global
 parser.add_option('-f', '--features',  action='store', type=str, dest='features',  default='', help='Comma separated list of features within tree')
 parser.add_option('-w', '--weightFeature',  action='store', type=str, dest='weightFeature',  default='DummyEvtWeight', help='Name of event weights feature in TTree')
 parser.add_option('-t', '--TreeName',  action='store', type=str, dest='treename',  default='Tree', help='Name of TTree name inside root files')
+parser.add_option('--epochs',  action='store', type=int, dest='epochs',  default=500, help='Number of training epochs')
+parser.add_option('-i', '--init_from',  action='store', type=str, dest='init_from',  default=None, help='Saved model (e.g. of a neighbouring variation) to fine-tune instead of training from scratch, use with fewer --epochs')
+parser.add_option('--freeze_layers',  action='store', type=int, dest='freeze_layers',  default=0, help='Number of leading layers kept fixed when fine-tuning with --init_from')
+parser.add_option('--distill_from',  action='store', type=str, dest='distill_from',  default=None, help='Saved teacher model (e.g. a wide network or an ensemble) to distill into a small network')
+parser.add_option('--unlabeled',  action='store', type=str, dest='unlabeled',  default=None, help='.npy file with additional unlabeled nominal events for --distill_from')
+parser.add_option('--student_hidden',  action='store', type=str, dest='student_hidden',  default='16,16', help='Comma separated hidden layer sizes of the student network for --distill_from')
 (opts, args) = parser.parse_args()
 nominal  = opts.nominal
 variation = opts.variation
@@ -29,6 +35,12 @@ global_name = opts.global_name
 features = opts.features.split(",")
 weightFeature = opts.weightFeature
 treename = opts.treename
+epochs = opts.epochs
+init_from = opts.init_from
+freeze_layers = opts.freeze_layers
+distill_from = opts.distill_from
+unlabeled = opts.unlabeled
+student_hidden = tuple(int(size) for size in opts.student_hidden.split(",") if size)
 #################################################
 
 #################################################
@@ -91,21 +103,40 @@ else:
 
 #######################################
 # Estimate the likelihood ratio
-estimator = RatioEstimator(
-    n_hidden=(50,50,50),
-    activation="relu"
-)
-estimator.train(
-    method='carl',
-    batch_size=50000,
-    n_epochs=500,
-    early_stopping=False,
-    x=x,
-    y=y,
-    w=w,
-    x0=x0, 
-    x1=x1,
-    scale_inputs=True,
-)
+if distill_from is not None:
+    estimator = RatioEstimator(
+        n_hidden=student_hidden,
+        activation="relu"
+    )
+    estimator.distill(
+        teacher=distill_from,
+        x=x,
+        y=y,
+        w=w,
+        x_unlabeled=unlabeled,
+        batch_size=50000,
+        n_epochs=epochs,
+        early_stopping=False,
+        scale_inputs=True,
+    )
+else:
+    estimator = RatioEstimator(
+        n_hidden=(50,50,50),
+        activation="relu"
+    )
+    estimator.train(
+        method='carl',
+        batch_size=50000,
+        n_epochs=epochs,
+        early_stopping=False,
+        x=x,
+        y=y,
+        w=w,
+        x0=x0, 
+        x1=x1,
+        scale_inputs=True,
+        init_from=init_from,
+        freeze_layers=freeze_layers,
+    )
 estimator.save('models/'+ global_name +'_carl_'+str(n), x, metaData, export_model = True)
 ########################################
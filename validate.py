@@ -3,6 +3,7 @@ import sys
 import logging
 import optparse
 from ml import RatioEstimator
+from ml.utils.cache import EvaluationCache
 from ml.utils.loading import Loader
 from ml.utils.tools   import load
 
@@ -30,6 +31,7 @@ xCT ,_ = load(f= p+'/test.root',events=eventVarsCT,jets=jetVars,leps=lepVars,n=i
 xCT = xCT[sorted(xCT.columns)]
 carl = RatioEstimator()
 carl.load('models/'+sample+'/'+var+'_carl_2000001')
+carl.evaluation_cache = EvaluationCache()
 r_hat, s_hat = carl.evaluate(x=xCT.to_numpy())
 weightCT = 1./r_hat
 